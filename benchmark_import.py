@@ -0,0 +1,69 @@
+"""
+Benchmark of the import time of the FFT/NTT modules, and check of their root tables.
+
+The roots of the cyclotomic polynomials are generated on first use for each degree
+(see fft.RootsDict and ntt.RootsDictZq) instead of being imported from the constant
+modules fft_constants and ntt_constants. This script measures, in fresh interpreters:
+- the import of the constant modules, which is what fft and ntt used to pay
+- the import of fft and ntt, then the first use of a given degree
+- the import of falcon
+and checks that the generated tables match the constant ones.
+
+Usage: python benchmark_import.py [repetitions] [n]
+"""
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+SNIPPETS = {
+    "fft_constants + ntt_constants": "import fft_constants, ntt_constants",
+    "numpy": "import numpy",
+    "fft + ntt": "import fft, ntt",
+    "fft + ntt, roots for n = {n}": "import fft, ntt; fft.roots_dict[{n}]; ntt.roots_dict_Zq[{n}]",
+    "falcon": "import falcon",
+}
+
+
+def time_import(code, repetitions, cold):
+    """
+    Return the best time (in ms) of code, each run in a fresh interpreter.
+    If cold is True, the modules are compiled again at each run (empty bytecode cache),
+    as in a short-lived process started from a fresh checkout or container image.
+    """
+    timer = ("import time; start = time.perf_counter(); " + code +
+             "; print((time.perf_counter() - start) * 1000)")
+    times = []
+    for _ in range(repetitions):
+        with tempfile.TemporaryDirectory() as cache:
+            options = ["-X", f"pycache_prefix={cache}"] if cold else []
+            output = subprocess.run([sys.executable, *options, "-c", timer], check=True,
+                                    capture_output=True, text=True).stdout
+        times.append(float(output))
+    return min(times)
+
+
+def check_tables():
+    """Check that the generated root tables are the ones of the constant modules."""
+    import fft
+    import ntt
+    import fft_constants
+    import ntt_constants
+    for n in fft_constants.roots_dict:
+        error = np.abs(np.array(fft.roots_dict[n]) - np.array(fft_constants.roots_dict[n])).max()
+        assert error < 1e-14, f"FFT roots for n = {n} differ by {error}"
+        assert ntt.roots_dict_Zq[n] == ntt_constants.roots_dict_Zq[n], f"NTT roots for n = {n} differ"
+    assert ntt.inv_mod_q(np.arange(ntt.q)).tolist() == ntt_constants.inv_mod_q, "Inverses mod q differ"
+    print("Generated root tables match fft_constants and ntt_constants")
+
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    check_tables()
+    print(f"{'import (best of ' + str(repetitions) + ')':<36} {'cached':>10} {'cold':>10}")
+    for name, code in SNIPPETS.items():
+        code = code.format(n=n)
+        cached = time_import(code, repetitions, cold=False)
+        cold = time_import(code, repetitions, cold=True)
+        print(f"{name.format(n=n):<36} {cached:7.2f} ms {cold:7.2f} ms")
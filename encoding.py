@@ -1,6 +1,8 @@
 """
-Compression and decompression routines for signatures.
+Compression and decompression routines for signatures, and fixed-width
+packing of polynomials for keys.
 """
+import numpy as np
 
 
 def compress(v, slen):
@@ -13,23 +15,31 @@ def compress(v, slen):
     - the sign is encoded on 1 bit
     - the 7 lower bits are encoded naively (binary)
     - the high bits are encoded in unary encoding
+
+    The bits are accumulated in an integer and flushed byte by byte.
     """
-    u = ""
+    out = bytearray()
+    acc, acc_len = 0, 0
     for coef in v:
-        # Encode the sign
-        s = "1" if coef < 0 else "0"
-        # Encode the low bits
-        s += format((abs(coef) % (1 << 7)), '#09b')[2:]
-        # Encode the high bits
-        s += "0" * (abs(coef) >> 7) + "1"
-        u += s
-    # The encoding is too long
-    if len(u) > 8 * slen:
-        return False
-    u += "0" * (8 * slen - len(u))
-    w = [int(u[8 * i: 8 * i + 8], 2) for i in range(len(u) // 8)]
-    x = bytes(w)
-    return x
+        coef = int(coef)
+        sign = 1 if coef < 0 else 0
+        abs_coef = -coef if sign else coef
+        high = abs_coef >> 7
+        # The encoding is too long
+        if 8 * len(out) + acc_len + 9 + high > 8 * slen:
+            return False
+        # Sign and low bits, then high zeros and a final one
+        acc = (acc << 8) | (sign << 7) | (abs_coef & 0x7F)
+        acc = (acc << (high + 1)) | 1
+        acc_len += 9 + high
+        while acc_len >= 8:
+            acc_len -= 8
+            out.append((acc >> acc_len) & 0xFF)
+        acc &= (1 << acc_len) - 1
+    if acc_len > 0:
+        out.append((acc << (8 - acc_len)) & 0xFF)
+    out += bytes(slen - len(out))
+    return bytes(out)
 
 
 def decompress(x, slen, n):
@@ -37,43 +47,93 @@ def decompress(x, slen, n):
     Take as input an encoding x, a bytelength slen and a length n, and
     return a list of integers v of length n such that x encode v.
     If such a list does not exist, the encoding is invalid and we output False.
+
+    The bits are read from an integer accumulator refilled byte by byte.
     """
     if (len(x) > slen):
         print("Too long")
         return False
-    w = list(x)
-    u = ""
-    for elt in w:
-        u += bin((1 << 8) ^ elt)[3:]
-    v = []
+    # Remove the last bits: the encoding ends at the last bit set to 1
+    end = len(x)
+    while end > 0 and x[end - 1] == 0:
+        end -= 1
+    if end == 0:
+        return False
+    last = x[end - 1]
+    nbits = 8 * end - ((last & -last).bit_length() - 1)
 
-    # Remove the last bits
-    while u[-1] == "0":
-        u = u[:-1]
-
-    try:
-        while (u != "") and (len(v) < n):
-            # Recover the sign of coef
-            sign = -1 if u[0] == "1" else 1
-            # Recover the 7 low bits of abs(coef)
-            low = int(u[1:8], 2)
-            i, high = 8, 0
-            # Recover the high bits of abs(coef)
-            while (u[i] == "0"):
-                i += 1
-                high += 1
-            # Compute coef
-            coef = sign * (low + (high << 7))
+    v = []
+    acc, acc_len, index, position = 0, 0, 0, 0
+    while (position < nbits) and (len(v) < n):
+        # At least the sign, the 7 low bits and the final one of the unary code are needed
+        if nbits - position < 9:
+            return False
+        if acc_len < 8:
+            acc = (acc << 8) | x[index]
+            index += 1
+            acc_len += 8
+        acc_len -= 8
+        byte = acc >> acc_len
+        acc &= (1 << acc_len) - 1
+        # Recover the high bits of abs(coef): count the zeros up to the next one
+        high = 0
+        while acc == 0:
+            high += acc_len
+            acc = x[index]
+            index += 1
+            acc_len = 8
+        high += acc_len - acc.bit_length()
+        acc_len = acc.bit_length() - 1
+        acc &= (1 << acc_len) - 1
+        position += 9 + high
+        # Compute coef
+        coef = (byte & 0x7F) + (high << 7)
+        if byte & 0x80:
             # Enforce a unique encoding for coef = 0
-            if (coef == 0) and (sign == -1):
+            if coef == 0:
                 return False
-            # Store intermediate results
-            v += [coef]
-            u = u[i + 1:]
-        # In this case, the encoding is invalid
-        if (len(v) != n):
-            return False
-        return v
-    # IndexError is raised if indices are read outside the table bounds
-    except IndexError:
+            coef = -coef
+        v.append(coef)
+    # In this case, the encoding is invalid
+    if (len(v) != n):
+        return False
+    return v
+
+
+def compress_many(vs, slen):
+    """
+    Compress a batch of lists of integers with compress.
+    """
+    return [compress(v, slen) for v in vs]
+
+
+def decompress_many(xs, slen, n):
+    """
+    Decompress a batch of encodings with decompress.
+    """
+    return [decompress(x, slen, n) for x in xs]
+
+
+def pack_bits(v, bits):
+    """
+    Take as input a list of non-negative integers v, each fitting in bits bits,
+    and return the bytestring of their concatenated big-endian encodings
+    (padded with zero bits to a whole number of bytes).
+    """
+    v = np.asarray(v, dtype=np.int64)
+    shifts = np.arange(bits - 1, -1, -1)
+    return np.packbits(((v[:, None] >> shifts) & 1).astype(np.uint8)).tobytes()
+
+
+def unpack_bits(x, bits, n):
+    """
+    Inverse of pack_bits: decode n integers of bits bits from the bytestring x.
+    Return False if x does not have the expected length or if the padding bits are not zero.
+    """
+    if len(x) != (n * bits + 7) // 8:
+        return False
+    stream = np.unpackbits(np.frombuffer(x, dtype=np.uint8))
+    if stream[n * bits:].any():
         return False
+    weights = 1 << np.arange(bits - 1, -1, -1)
+    return stream[:n * bits].reshape(n, bits).astype(np.int64) @ weights
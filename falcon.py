@@ -3,16 +3,18 @@ Implementation of Falcon signature scheme.
 Details at: https://falcon-sign.info/
 """
 from common import q
+import numpy as np
 from numpy import set_printoptions
-from math import sqrt
-from fft import fft, ifft, sub, neg, add_fft, mul_fft
-from ntt import sub_zq, mul_zq, div_zq
-from ffsampling import gram, ffldl_fft, ffsampling_fft
-from ntrugen import ntru_gen
-from encoding import compress, decompress
+from fft import fft, ifft, add_fft, mul_fft
+from ntt import ntt, intt, sub_zq, mul_ntt, div_ntt
+from ffsampling import gram, gram_fft, ffldl_fft, ffsampling_fft_inplace, SamplingWorkspace
+from ntrugen import ntru_gen_fft, kronecker_reduction
+from encoding import compress, decompress, decompress_many, pack_bits, unpack_bits
 from Crypto.Hash import SHAKE256
-from os import urandom
-from rng import ChaCha20
+from rng import ChaCha20, RandomPool
+from threading import local
+import mmap
+import os
 import sys
 if sys.version_info >= (3, 4):
     from importlib import reload
@@ -29,6 +31,27 @@ HEAD_LENGTH = 1
 SALT_BYTES = 40
 SEED_BYTES = 56
 
+# Serialized keys: the header is the tag plus log2(n)
+PUBLIC_KEY_TAG = 0x00
+SECRET_KEY_TAG = 0x50
+# Bits per coefficient of h in a serialized public key
+PUBLIC_KEY_BITS = 14
+# Flags of a serialized secret key: integer type of f, g, F, G (low two bits),
+# and presence of the precomputed B0_fft and T_fft
+SECRET_KEY_DTYPES = ["<i1", "<i2", "<i4"]
+SECRET_KEY_PRECOMPUTED = 0x04
+# Alignment of the precomputed arrays in a serialized secret key
+SECRET_KEY_ALIGNMENT = 16
+
+# Default source of randomness for signing: a buffered os.urandom
+random_pool = RandomPool()
+
+# Number of messages sampled together by sign_many. Each thread keeps, for each degree n,
+# a sampling workspace for a single point and one for a chunk of SIGNING_CHUNK points,
+# shared by all the secret keys
+SIGNING_CHUNK = 64
+sampling_workspaces = local()
+
 FalconParameters = {
     2: {"n": 2, "sigma": 144.81, "sigmin": 1.116, "sig_bound": 101498, "sig_bytelen": 44},
     4: {"n": 4, "sigma": 146.84, "sigmin": 1.132, "sig_bound": 208714, "sig_bytelen": 47},
@@ -42,15 +65,141 @@ FalconParameters = {
     1024: {"n": 1024, "sigma": 168.39, "sigmin": 1.298, "sig_bound": 70265242, "sig_bytelen": 1280}
 }
 
-def display_ldl_tree(tree, prefix=""):
+def seeded_randombytes(seed, randombytes):
+    """
+    Return the source of randomness for signing: a ChaCha20 PRG seeded with seed
+    if a seed is given, randombytes otherwise.
+    """
+    if seed is None:
+        return randombytes
+    if len(seed) != SEED_BYTES:
+        raise ValueError(f"The seed must be {SEED_BYTES} bytes long")
+    return RandomPool(ChaCha20(seed).randombytes)
+
+def hash_to_point(message, salt, n):
+    """
+    Hash a message and a salt to a polynomial of size n with coefficients mod q,
+    by rejection sampling of 16-bit values from a SHAKE256 stream.
+    """
+    return PointHasher(salt, n).update(message).digest()
+
+def hash_to_point_many(messages, salts, n):
+    """
+    Hash a batch of (message, salt) pairs as hash_to_point does,
+    and return the points as an array with one row per pair.
+    """
+    if len(messages) != len(salts):
+        raise ValueError("messages and salts must have the same length")
+    hashed = np.empty((len(messages), n), dtype=np.int64)
+    for i, (message, salt) in enumerate(zip(messages, salts)):
+        hashed[i] = hash_to_point(message, salt, n)
+    return hashed
+
+def squeeze_point(shake, n):
+    """
+    Return a polynomial of size n with coefficients mod q (as an int64 array), read from
+    shake by rejection sampling of 16-bit big-endian values below k * q, reduced mod q.
+    The stream is squeezed in blocks, a little larger than what n values need on average,
+    and only squeezed again if too many values were rejected.
+    """
+    if q > (1 << 16):
+        raise ValueError("Modulus is too large")
+    k = (1 << 16) // q
+    hashed = np.empty(n, dtype=np.int64)
+    i = 0
+    while i < n:
+        # About 6% of the values are rejected for q = 12289: squeeze 1/8 more than missing
+        count = (n - i) + ((n - i) >> 3) + 8
+        candidates = np.frombuffer(shake.read(2 * count), dtype=">u2")
+        accepted = candidates[candidates < k * q][:n - i]
+        hashed[i:i + len(accepted)] = accepted % q
+        i += len(accepted)
+    return hashed
+
+class PointHasher:
+    """
+    Incremental hash_to_point: the salt is absorbed first, then the message
+    chunk by chunk, so that it never has to be held in memory at once.
+    """
+    __slots__ = ("n", "shake")
+
+    def __init__(self, salt, n):
+        self.n = n
+        self.shake = SHAKE256.new()
+        self.shake.update(salt)
+
+    def update(self, chunk):
+        """Absorb the next chunk of the message."""
+        self.shake.update(chunk)
+        return self
+
+    def digest(self):
+        """Return the point of the message. No chunk can be absorbed afterwards."""
+        return squeeze_point(self.shake, self.n)
+
+
+class Signer:
+    """
+    Signature of a message given chunk by chunk, returned by SecretKey.signer:
+    call update for each chunk, then finalize to get the signature.
+    """
+    __slots__ = ("sk", "salt", "randombytes", "hasher")
+
+    def __init__(self, sk, salt, randombytes):
+        self.sk = sk
+        self.salt = salt
+        self.randombytes = randombytes
+        self.hasher = PointHasher(salt, sk.n)
+
+    def update(self, chunk):
+        self.hasher.update(chunk)
+        return self
+
+    def finalize(self):
+        return self.sk.sign_hashed(self.hasher.digest(), self.salt, self.randombytes)
+
+
+class Verifier:
+    """
+    Verification of a signature of a message given chunk by chunk, returned by
+    PublicKey.verifier: call update for each chunk, then finalize to get the result.
+    """
+    __slots__ = ("pk", "signature", "hasher")
+
+    def __init__(self, pk, signature):
+        self.pk = pk
+        self.signature = signature
+        self.hasher = PointHasher(signature[HEAD_LENGTH:HEAD_LENGTH + SALT_BYTES], pk.n)
+
+    def update(self, chunk):
+        self.hasher.update(chunk)
+        return self
+
+    def finalize(self):
+        return self.pk.verify_hashed(self.hasher.digest(), self.signature)
+
+
+def parse_header(data, tag):
+    """Return the degree n encoded in the first byte of a serialized key with the given tag."""
+    if len(data) == 0:
+        raise ValueError("Empty key")
+    logn = data[0] - tag
+    if logn not in log_degree_mapping.values():
+        raise ValueError(f"Invalid key header {data[0]:#04x}")
+    return 1 << logn
+
+def display_ldl_tree(tree, prefix="", depth=0, index=0):
     branch = "|______"
     link1 = "|      "
     link2 = "       "
-    if len(tree) == 3:
-        head = prefix + branch + str(tree[0]) if prefix else str(tree[0])
-        return f"{head}\n{display_ldl_tree(tree[1], prefix + link1)}{display_ldl_tree(tree[2], prefix + link2)}"
+    size = tree.shape[1] >> depth
+    if size > 1:
+        node = tree[depth, index * size:(index + 1) * size]
+        head = prefix + branch + str(node) if prefix else str(node)
+        return (f"{head}\n{display_ldl_tree(tree, prefix + link1, depth + 1, 2 * index)}"
+                f"{display_ldl_tree(tree, prefix + link2, depth + 1, 2 * index + 1)}")
     else:
-        return prefix[:-len(branch)] + "|____> " + str(tree) + "\n"
+        return prefix[:-len(branch)] + "|____> " + str(tree[depth, index].real) + "\n"
 
 def normalize_ldl_tree(tree, standard_deviation):
     """
@@ -58,117 +207,413 @@ def normalize_ldl_tree(tree, standard_deviation):
     This is used to scale the lattice vectors to a certain standard deviation, relevant in 
     cryptographic schemes.
     """
-    if len(tree) == 3:
-        # If the current node has children, recursively normalize both subtrees
-        normalize_ldl_tree(tree[1], standard_deviation)
-        normalize_ldl_tree(tree[2], standard_deviation)
-    else:
-        # If the current node is a leaf, normalize the vector:
-        # Set the first element to the standard deviation divided by the square root of the real 
-        # part of the current value
-        # This operation adjusts the norm of the vector represented by the leaf
-        tree[0] = standard_deviation / sqrt(tree[0].real)
-        # Set the second element to zero, typically used to reset or clear the imaginary part or 
-        # an auxiliary value
-        tree[1] = 0
+    # The leaves are the last row of the tree (see ffldl_fft): each of them is replaced
+    # by the standard deviation divided by the square root of its (real) value
+    tree[-1] = standard_deviation / np.sqrt(tree[-1].real)
 
 
 class PublicKey:
-    def __init__(self, sk):
-        self.n = sk.n
-        self.h = sk.h
-        self.hash_to_point = sk.hash_to_point
-        self.signature_bound = sk.signature_bound
-        self.verify = sk.verify
+    """
+    A Falcon public key. It only holds n, h (as an int16 array), the NTT of h and the
+    signature parameters, and keeps no reference to the secret key it comes from.
+    """
+    __slots__ = ("n", "h", "h_ntt", "signature_bound", "sig_bytelen")
+
+    def __init__(self, sk=None, h=None):
+        """
+        Build the public key of the secret key sk, or the public key of polynomial h.
+        """
+        if (sk is None) == (h is None):
+            raise TypeError("Either a secret key or h must be given")
+        if sk is not None:
+            h, h_ntt = sk.h, sk.h_ntt
+        else:
+            h = np.asarray(h, dtype=np.int64) % q
+            h_ntt = ntt(h)
+        self.n = len(h)
+        if self.n not in FalconParameters:
+            raise ValueError(f"Unsupported degree {self.n}")
+        # The coefficients of h and of its NTT are below q < 2 ** 15
+        self.h = np.asarray(h, dtype=np.int16)
+        # The NTT of h, computed once, so that verifying only costs ntt(s1) and one intt
+        self.h_ntt = np.asarray(h_ntt, dtype=np.int16)
+        self.signature_bound = FalconParameters[self.n]["sig_bound"]
+        self.sig_bytelen = FalconParameters[self.n]["sig_bytelen"]
 
     def __repr__(self):
         return f"Public Key for n = {self.n}:\nh = {self.h}\nThe public key polynomial satisfies h*f = g mod (Phi, q)\n"
 
+    def hash_to_point(self, message, salt):
+        return hash_to_point(message, salt, self.n)
+
+    def to_bytes(self):
+        """
+        Serialize the public key: a header byte (0x00 + log2(n)), then the coefficients
+        of h on 14 bits each.
+        """
+        header = bytes([PUBLIC_KEY_TAG + log_degree_mapping[self.n]])
+        return header + pack_bits(self.h, PUBLIC_KEY_BITS)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a public key serialized by to_bytes.
+        """
+        n = parse_header(data, PUBLIC_KEY_TAG)
+        h = unpack_bits(bytes(data[1:]), PUBLIC_KEY_BITS, n)
+        if h is False or (h >= q).any():
+            raise ValueError("Invalid public key encoding")
+        return cls(h=h)
+
+    def verify(self, message, signature):
+        """
+        Verify a signature against a given message.
+        """
+        return self.verifier(signature).update(message).finalize()
+
+    def verifier(self, signature):
+        """
+        Return a Verifier of signature, for a message given chunk by chunk:
+        the salt of the signature is absorbed first, then each chunk as it comes.
+        """
+        return Verifier(self, signature)
+
+    def verify_hashed(self, hashed, signature):
+        """
+        Verify a signature against the point hashed from its salt and a message
+        (see hash_to_point).
+        """
+        # Extract the compressed part of the signature
+        enc_s = signature[HEAD_LENGTH + SALT_BYTES:]
+        # Decompress the signature component
+        s1 = decompress(enc_s, self.sig_bytelen - HEAD_LENGTH - SALT_BYTES, self.n)
+
+        # If decompression fails, the signature is invalid
+        if s1 is False:
+            return False
+
+        # Calculate the first part of the signature from hash and the second part of the signature,
+        # using the cached NTT of h
+        s0 = sub_zq(hashed, intt(mul_ntt(ntt(s1), self.h_ntt)))
+        # Normalize the coefficients of s0 to be within the range (-q/2, q/2]
+        s0 = (s0 + (q >> 1)) % q - (q >> 1)
+        # Calculate the norm of the signature to check if it's within the allowed bound
+        norm_sign = int(np.dot(s0, s0)) + sum(x ** 2 for x in s1)
+
+        # Return True if the signature is within the allowed bound, indicating it's valid
+        return norm_sign <= self.signature_bound
+
+    def verify_many(self, messages, signatures):
+        """
+        Verify a batch of (message, signature) pairs.
+        Return a boolean array and, for each pair, None if the signature is valid
+        or the reason why it was rejected.
+        """
+        if len(messages) != len(signatures):
+            raise ValueError("messages and signatures must have the same length")
+        batch = len(messages)
+        reasons = [None] * batch
+        s1 = np.zeros((batch, self.n), dtype=np.int64)
+        hashed = np.zeros((batch, self.n), dtype=np.int64)
+        decoded = decompress_many([signature[HEAD_LENGTH + SALT_BYTES:] for signature in signatures],
+                                  self.sig_bytelen - HEAD_LENGTH - SALT_BYTES, self.n)
+        for i, s1_i in enumerate(decoded):
+            if s1_i is False:
+                reasons[i] = "decompression failed"
+                continue
+            s1[i] = s1_i
+        # Only the messages of the decompressed signatures are hashed
+        kept = [i for i in range(batch) if reasons[i] is None]
+        hashed[kept] = hash_to_point_many([messages[i] for i in kept],
+                                          [signatures[i][HEAD_LENGTH:HEAD_LENGTH + SALT_BYTES] for i in kept],
+                                          self.n)
+
+        # Same computation as in verify, for all the signatures at once
+        s0 = sub_zq(hashed, intt(mul_ntt(ntt(s1), self.h_ntt)))
+        s0 = (s0 + (q >> 1)) % q - (q >> 1)
+        norm_sign = (s0 ** 2).sum(axis=-1) + (s1 ** 2).sum(axis=-1)
+
+        valid = norm_sign <= self.signature_bound
+        for i in range(batch):
+            if reasons[i] is not None:
+                valid[i] = False
+            elif not valid[i]:
+                reasons[i] = "norm bound exceeded"
+        return valid, reasons
+
+def compact_array(poly):
+    """Return the integers of poly as an array of the smallest signed integer type that holds them."""
+    poly = np.asarray(poly, dtype=np.int64)
+    bound = int(np.abs(poly).max(initial=0))
+    dtype = next(dtype for dtype in (np.int8, np.int16, np.int32, np.int64) if bound <= np.iinfo(dtype).max)
+    return poly.astype(dtype)
+
+
 class SecretKey:
-    def __init__(self, n, polys=None):
+    def __init__(self, n, polys=None, precomputed=None, lazy=False):
+        """
+        Generate a secret key of degree n, or build it from polys = [f, g, F, G].
+        precomputed = (B0_fft, T_fft) can also be given with polys, to skip the
+        computation of the LDL tree (see from_bytes).
+        If lazy is True, B0_fft and T_fft are only computed when first needed.
+        """
         self.n = n
         self.sigma = FalconParameters[n]["sigma"]
         self.sigmin = FalconParameters[n]["sigmin"]
         self.signature_bound = FalconParameters[n]["sig_bound"]
         self.sig_bytelen = FalconParameters[n]["sig_bytelen"]
 
-        # Generate NTRU polynomials (f, g, F, G) satisfying the NTRU equation
-        self.f, self.g, self.F, self.G = ntru_gen(n)
+        f_fft = g_fft = None
+        if polys is None:
+            # Generate NTRU polynomials (f, g, F, G) satisfying the NTRU equation,
+            # along with the FFTs of f and g computed while checking them
+            polys, (f_fft, g_fft) = ntru_gen_fft(n)
+        else:
+            polys = [[int(coef) for coef in poly] for poly in polys]
+            if any(len(poly) != n for poly in polys):
+                raise ValueError(f"The polynomials must have {n} coefficients")
+            # The polynomials must satisfy the NTRU equation f * G - g * F = q mod (x ** n + 1)
+            f, g, F, G = polys
+            fG = kronecker_reduction(f, G)
+            gF = kronecker_reduction(g, F)
+            if [a - b for a, b in zip(fG, gF)] != [q] + [0] * (n - 1):
+                raise ValueError("The polynomials do not satisfy the NTRU equation")
+        # The polynomials are stored as arrays of small integers
+        self.f, self.g, self.F, self.G = [compact_array(poly) for poly in polys]
+
+        # B0_fft and T_fft, or None until they are computed
+        self.precomputed = precomputed
+        if precomputed is None and not lazy:
+            self.precompute(f_fft, g_fft)
+
+        # Calculate the public key h from the private key components f and g,
+        # keeping its NTT for verification (the coefficients are below q < 2 ** 15)
+        self.h_ntt = div_ntt(ntt(self.g), ntt(self.f)).astype(np.int16)
+        self.h = intt(self.h_ntt).astype(np.int16)
+
+    def __repr__(self, detailed=False):
+        details = f"Private Key for n = {self.n}:\nNTRU polynomials f, g, F, G satisfy fG - gF = q mod Phi\nf = {self.f}\ng = {self.g}\nF = {self.F}\nG = {self.G}\nB0 = {self.B0}\nG0 = {self.G0}"
+        return details + "\nFFT Tree:\n" + display_ldl_tree(self.T_fft) if detailed else details
 
-        # Build the basis B0 for the NTRU lattice
-        B0 = [[self.g, neg(self.f)], [self.G, neg(self.F)]]
-        self.B0 = B0
+    def precompute(self, f_fft=None, g_fft=None):
+        """
+        Return (B0_fft, T_fft), computing them from f, g, F, G if they are not there.
+        The FFTs of f and g can be given if they are already known.
+        Two threads signing for the first time may both compute them, with the same result.
+        """
+        precomputed = self.precomputed
+        if precomputed is None:
+            f_fft = fft(self.f) if f_fft is None else f_fft
+            g_fft = fft(self.g) if g_fft is None else g_fft
+            # FFT of the basis [[g, -f], [G, -F]] of the NTRU lattice
+            B0_fft = np.array([[g_fft, -f_fft], [fft(self.G), -fft(self.F)]])
+            # LDL decomposition of the Gram matrix of B0, computed in the Fourier domain
+            T_fft = ffldl_fft(gram_fft(B0_fft))
+            # Normalize the LDL tree which represents the lattice basis to ensure it meets the required standard deviation
+            normalize_ldl_tree(T_fft, self.sigma)
+            precomputed = self.precomputed = (B0_fft, T_fft)
+        return precomputed
 
-        # Calculate the Gram matrix of B0
-        G0 = gram(B0)
-        self.G0 = G0
+    def release(self):
+        """
+        Free B0_fft and T_fft.
+        They are computed again on the next signature.
+        """
+        self.precomputed = None
 
-        # Compute the FFT of the basis and the Gram matrix to speed up further calculations
-        self.B0_fft = [[fft(elt) for elt in row] for row in B0]
-        G0_fft = [[fft(elt) for elt in row] for row in G0]
+    @property
+    def B0_fft(self):
+        """The FFT of the basis B0, as an array of shape (2, 2, n)."""
+        return self.precompute()[0]
 
-        # Compute the LDL decomposition of the Gram matrix in the Fourier domain
-        self.T_fft = ffldl_fft(G0_fft)
+    @property
+    def T_fft(self):
+        """The normalized ffLDL tree of the Gram matrix of B0 (see ffldl_fft)."""
+        return self.precompute()[1]
 
-        # Normalize the LDL tree which represents the lattice basis to ensure it meets the required standard deviation
-        normalize_ldl_tree(self.T_fft, self.sigma)
+    def memory_footprint(self):
+        """
+        Return the memory used by the arrays of the key, in bytes, by component.
+        """
+        footprint = {name: getattr(self, name).nbytes for name in ("f", "g", "F", "G", "h", "h_ntt")}
+        if self.precomputed is not None:
+            footprint["B0_fft"] = self.precomputed[0].nbytes
+            footprint["T_fft"] = self.precomputed[1].nbytes
+        footprint["total"] = sum(footprint.values())
+        return footprint
 
-        # Calculate the public key h from the private key components f and g
-        self.h = div_zq(self.g, self.f)
+    @property
+    def B0(self):
+        """The basis of the NTRU lattice."""
+        return [[self.g, -self.f], [self.G, -self.F]]
 
-    def __repr__(self, detailed=False):
-        details = f"Private Key for n = {self.n}:\nNTRU polynomials f, g, F, G satisfy fG - gF = q mod Phi\nf = {self.f}\ng = {self.g}\nF = {self.F}\nG = {self.G}\nB0 = {self.B0}\nG0 = {self.G0}"
-        return details + "\nFFT Tree:\n" + display_ldl_tree(self.T_fft) if detailed else details
+    @property
+    def G0(self):
+        """The Gram matrix of B0."""
+        return gram(self.B0)
 
     def hash_to_point(self, message, salt):
-        if q > (1 << 16):
-            raise ValueError("Modulus is too large")
-        k = (1 << 16) // q
-        shake = SHAKE256.new()
-        shake.update(salt)
-        shake.update(message)
-        hashed = [0] * self.n
-        i = 0
-        while i < self.n:
-            two_bytes = shake.read(2)
-            element = (two_bytes[0] << 8) + two_bytes[1]
-            if element < k * q:
-                hashed[i] = element % q
-                i += 1
-        return hashed
-
-    def sample_preimage(self, point):
+        return hash_to_point(message, salt, self.n)
+
+    def to_bytes(self, precomputed=False):
+        """
+        Serialize the secret key:
+        - a header byte (0x50 + log2(n)) and a flags byte
+        - the coefficients of f, g, F, G as little-endian integers of 1, 2 or 4 bytes
+          (the smallest size that fits all of them, given by the low two bits of the flags)
+        - if precomputed is True (flag 0x04), the raw complex128 arrays B0_fft and T_fft,
+          aligned on 16 bytes, so that loading the key does not recompute them
+        """
+        polys = np.array([self.f, self.g, self.F, self.G], dtype=np.int64)
+        bound = int(np.abs(polys).max())
+        width = next(i for i, dtype in enumerate(SECRET_KEY_DTYPES) if bound <= np.iinfo(dtype).max)
+        flags = width | (SECRET_KEY_PRECOMPUTED if precomputed else 0)
+        data = bytearray([SECRET_KEY_TAG + log_degree_mapping[self.n], flags])
+        data += polys.astype(SECRET_KEY_DTYPES[width]).tobytes()
+        if precomputed:
+            data += bytes(-len(data) % SECRET_KEY_ALIGNMENT)
+            data += np.asarray(self.B0_fft, dtype="<c16").tobytes()
+            data += np.asarray(self.T_fft, dtype="<c16").tobytes()
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a secret key serialized by to_bytes, without running ntru_gen.
+        data can be any buffer (bytes, mmap...): the precomputed arrays, if present,
+        are read-only views of it, not copies.
+        """
+        n = parse_header(data, SECRET_KEY_TAG)
+        if len(data) < 2 or data[1] & ~(3 | SECRET_KEY_PRECOMPUTED) or data[1] & 3 == 3:
+            raise ValueError("Invalid secret key flags")
+        dtype = np.dtype(SECRET_KEY_DTYPES[data[1] & 3])
+        offset = 2 + 4 * n * dtype.itemsize
+        precomputed = None
+        if data[1] & SECRET_KEY_PRECOMPUTED:
+            depth = log_degree_mapping[n]
+            offset += -offset % SECRET_KEY_ALIGNMENT
+            expected = offset + 16 * n * (4 + depth + 1)
+            if len(data) != expected:
+                raise ValueError("Invalid secret key length")
+            B0_fft = np.frombuffer(data, dtype="<c16", count=4 * n, offset=offset).reshape(2, 2, n)
+            T_fft = np.frombuffer(data, dtype="<c16", count=(depth + 1) * n, offset=offset + 64 * n)
+            precomputed = (B0_fft, T_fft.reshape(depth + 1, n))
+        elif len(data) != offset:
+            raise ValueError("Invalid secret key length")
+        polys = np.frombuffer(data, dtype=dtype, count=4 * n, offset=2).reshape(4, n).tolist()
+        return cls(n, polys, precomputed)
+
+    def save(self, path, precomputed=True, exclusive=False):
+        """
+        Write the key serialized by to_bytes to path, readable by the owner only.
+        The key is written to a temporary file, then moved to path, so that path never
+        holds a partially written key (load memory-maps it). If exclusive is True,
+        raise FileExistsError if path already exists, instead of replacing it.
+        """
+        temporary = f"{path}.{os.urandom(8).hex()}.tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(self.to_bytes(precomputed))
+            if exclusive:
+                # Unlike os.replace, os.link fails if path exists
+                os.link(temporary, path)
+            else:
+                os.replace(temporary, path)
+        finally:
+            if os.path.lexists(temporary):
+                os.remove(temporary)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a key written by save. The file is memory-mapped, so that the
+        precomputed arrays are read from the page cache instead of being copied.
+        """
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_bytes(data)
+
+    def sampling_workspace(self, batch=()):
+        """
+        Return a sampling workspace for points of shape batch + (n,).
+        The workspaces for a single point and for SIGNING_CHUNK points are kept by the
+        current thread and shared by all the keys of degree n; any other shape gets a
+        new workspace, freed after its use, so that the memory kept does not grow with
+        the number of keys or the batches signed.
+        """
+        batch = tuple(batch)
+        if batch not in ((), (SIGNING_CHUNK,)):
+            return SamplingWorkspace(self.n, batch)
+        workspaces = getattr(sampling_workspaces, "by_shape", None)
+        if workspaces is None:
+            workspaces = sampling_workspaces.by_shape = {}
+        key = (self.n, batch)
+        if key not in workspaces:
+            workspaces[key] = SamplingWorkspace(self.n, batch)
+        return workspaces[key]
+
+    def sample_preimage(self, point, randombytes=random_pool):
+        """
+        Sample a short preimage s = (s0, s1) of point.
+        point can also be an array of points (one per row), in which case
+        s0 and s1 are arrays with one row per point.
+        """
+        point = np.asarray(point, dtype=np.int64)
+        workspace = self.sampling_workspace(point.shape[:-1])
         point_fft = fft(point)
         [[a, b], [c, d]] = self.B0_fft
-        t0_fft = [point_fft[i] * d[i] / q for i in range(self.n)]
-        t1_fft = [-point_fft[i] * b[i] / q for i in range(self.n)]
-        t_fft = [t0_fft, t1_fft]
-        z_fft = ffsampling_fft(t_fft, self.T_fft, self.sigmin, urandom)
+        # The target t = (point * d / q, -point * b / q) is computed in the workspace
+        t0_fft, t1_fft = workspace.t0[0], workspace.t1[0]
+        np.multiply(point_fft, d, out=t0_fft)
+        t0_fft /= q
+        np.negative(point_fft, out=t1_fft)
+        t1_fft *= b
+        t1_fft /= q
+        z_fft = ffsampling_fft_inplace([t0_fft, t1_fft], self.T_fft, self.sigmin, randombytes, workspace)
         v0_fft = add_fft(mul_fft(z_fft[0], a), mul_fft(z_fft[1], c))
         v1_fft = add_fft(mul_fft(z_fft[0], b), mul_fft(z_fft[1], d))
-        v0 = [int(round(x)) for x in ifft(v0_fft)]
-        v1 = [int(round(x)) for x in ifft(v1_fft)]
-        s = [sub(point, v0), neg(v1)]
+        v0 = np.rint(ifft(v0_fft)).astype(int)
+        v1 = np.rint(ifft(v1_fft)).astype(int)
+        s = [point - v0, -v1]
         return s
 
-    def sign(self, message):
+    def sign(self, message, seed=None, salt=None, randombytes=random_pool):
         """
         Generate a signature for a given message using the Falcon signature scheme.
+        If a seed of SEED_BYTES bytes is given, the randomness is drawn from a ChaCha20
+        PRG seeded with it, so that the signature is reproducible.
+        The salt can also be given, otherwise it is drawn from the same randomness.
+        """
+        return self.signer(seed, salt, randombytes).update(message).finalize()
+
+    def signer(self, seed=None, salt=None, randombytes=random_pool):
+        """
+        Return a Signer, for a message given chunk by chunk: the salt is absorbed first,
+        then each chunk as it comes. seed, salt and randombytes are as in sign.
+        """
+        randombytes = seeded_randombytes(seed, randombytes)
+        # Generate a random salt, unless one is provided
+        if salt is None:
+            salt = bytes(randombytes(SALT_BYTES))
+        elif len(salt) != SALT_BYTES:
+            raise ValueError(f"The salt must be {SALT_BYTES} bytes long")
+        return Signer(self, salt, randombytes)
+
+    def sign_hashed(self, hashed, salt, randombytes=random_pool):
+        """
+        Generate a signature from the point hashed from salt and a message (see hash_to_point).
         """
         # Generate the header for the signature, indicating the parameters used
         header = (0x30 + log_degree_mapping[self.n]).to_bytes(1, "little")
-        # Generate a random salt
-        salt = urandom(SALT_BYTES)
-        # Hash the message with the salt to produce a point in the lattice
-        hashed = self.hash_to_point(message, salt)
-        
+
         # Attempt to generate a valid signature until successful
         while True:
             # Sample a preimage from the hashed message
-            s = self.sample_preimage(hashed)
+            s = self.sample_preimage(hashed, randombytes)
             
             # Calculate the Euclidean norm of the signature vector
-            norm_sign = sum(x ** 2 for x in s[0]) + sum(x ** 2 for x in s[1])
+            norm_sign = int((s[0] ** 2).sum() + (s[1] ** 2).sum())
             
             # Check if the signature is within the allowed bound
             if norm_sign <= self.signature_bound:
@@ -179,30 +624,37 @@ class SecretKey:
                 if enc_s is not False:
                     return header + salt + enc_s
 
-    def verify(self, message, signature):
+    def sign_many(self, messages, seed=None, randombytes=random_pool):
         """
-        Verify a signature against a given message.
+        Generate signatures for a batch of messages.
+        The LDL tree is walked once for each chunk of SIGNING_CHUNK messages still
+        to be signed, and only the messages whose signature was rejected are sampled again.
+        As in sign, a seed makes the whole batch reproducible.
         """
-        # Extract the salt from the signature
-        salt = signature[HEAD_LENGTH:HEAD_LENGTH + SALT_BYTES]
-        # Extract the compressed part of the signature
-        enc_s = signature[HEAD_LENGTH + SALT_BYTES:]
-        # Decompress the signature component
-        s1 = decompress(enc_s, self.sig_bytelen - HEAD_LENGTH - SALT_BYTES, self.n)
-
-        # If decompression fails, the signature is invalid
-        if s1 is False:
-            return False
+        randombytes = seeded_randombytes(seed, randombytes)
+        header = (0x30 + log_degree_mapping[self.n]).to_bytes(1, "little")
+        salts = [bytes(randombytes(SALT_BYTES)) for _ in messages]
+        hashed = hash_to_point_many(messages, salts, self.n)
 
-        # Hash the message with the salt to produce a point in the lattice
-        hashed = self.hash_to_point(message, salt)
+        signatures = [None] * len(messages)
+        # The rejected messages go back at the end of the queue
+        pending = list(range(len(messages)))
+        while pending:
+            chunk = np.array(pending[:SIGNING_CHUNK], dtype=np.int64)
+            del pending[:SIGNING_CHUNK]
+            s0, s1 = self.sample_preimage(hashed[chunk], randombytes)
+            norm_sign = (s0 ** 2).sum(axis=-1) + (s1 ** 2).sum(axis=-1)
+            for i, index in enumerate(chunk):
+                if norm_sign[i] <= self.signature_bound:
+                    enc_s = compress(s1[i], self.sig_bytelen - HEAD_LENGTH - SALT_BYTES)
+                    if enc_s is not False:
+                        signatures[index] = header + salts[index] + enc_s
+                        continue
+                pending.append(index)
+        return signatures
 
-        # Calculate the first part of the signature from hash and the second part of the signature
-        s0 = sub_zq(hashed, mul_zq(s1, self.h))
-        # Normalize the coefficients of s0 to be within the range (-q/2, q/2]
-        s0 = [(x + (q >> 1)) % q - (q >> 1) for x in s0]
-        # Calculate the norm of the signature to check if it's within the allowed bound
-        norm_sign = sum(x ** 2 for x in s0) + sum(x ** 2 for x in s1)
-
-        # Return True if the signature is within the allowed bound, indicating it's valid
-        return norm_sign <= self.signature_bound
\ No newline at end of file
+    def verify(self, message, signature):
+        """
+        Verify a signature against a given message.
+        """
+        return PublicKey(self).verify(message, signature)
@@ -5,11 +5,14 @@
 - the Fast Fourier sampling (only in FFT)
 .
 """
+import numpy as np
 from common import split, merge                         # Split, merge
 from fft import add, sub, mul, div, adj                 # Operations in coef.
 from fft import add_fft, sub_fft, mul_fft, div_fft, adj_fft  # Ops in FFT
 from fft import split_fft, merge_fft, fft_ratio         # FFT
-from samplerz import samplerz                           # Gaussian sampler in Z
+from fft import split_fft_into, merge_fft_into          # FFT, in place
+from fft import scalar_twiddles                         # FFT, scalar
+from samplerz import samplerz, samplerz_batch           # Gaussian sampler in Z
 
 
 def gram(B):
@@ -31,6 +34,19 @@ def gram(B):
     return G
 
 
+def gram_fft(B_fft):
+    """Compute the Gram matrix of B.
+
+    Args:
+        B_fft: a matrix, as an array of shape (rows, cols, n)
+
+    Format: FFT
+    """
+    B_fft = np.asarray(B_fft, dtype=np.complex128)
+    # G[i][j] = sum over k of B[i][k] * adj(B[j][k]), pointwise in the FFT domain
+    return np.einsum("ikn,jkn->ijn", B_fft, adj_fft(B_fft))
+
+
 def ldl(G):
     """
     Compute the LDL decomposition of G. Only works with 2 * 2 matrices.
@@ -123,20 +139,37 @@ def ffldl_fft(G):
     Format: FFT
 
     Corresponds to algorithm 9 (ffLDL) of Falcon's documentation.
+
+    The tree is returned as a flat complex array T of shape (log2(n) + 1, n),
+    computed level by level for all the nodes of a level at once:
+    - the node k of depth d has size m = n >> d, and its l10 is T[d, k * m:(k + 1) * m]
+    - its children are the nodes 2 * k and 2 * k + 1 of depth d + 1
+    - the last row holds the leaves, which are real
     """
     n = len(G[0][0]) * fft_ratio
-    L, D = ldl_fft(G)
-    # Coefficients of L, D are elements of R[x]/(x^n - x^(n/2) + 1), in FFT representation
-    if (n > 2):
-        # A bisection is done on elements of a 2*2 diagonal matrix.
-        d00, d01 = split_fft(D[0][0])
-        d10, d11 = split_fft(D[1][1])
-        G0 = [[d00, d01], [adj_fft(d01), d00]]
-        G1 = [[d10, d11], [adj_fft(d11), d10]]
-        return [L[1][0], ffldl_fft(G0), ffldl_fft(G1)]
-    elif (n == 2):
-        # End of the recursion (each element is real).
-        return [L[1][0], D[0][0], D[1][1]]
+    depth = n.bit_length() - 1
+    T = np.empty((depth + 1, n), dtype=np.complex128)
+    # Entries of the Gram matrices of the nodes of the current level, one node per row
+    g00 = np.asarray(G[0][0], dtype=np.complex128).reshape(1, n)
+    g01 = np.asarray(G[0][1], dtype=np.complex128).reshape(1, n)
+    g10 = np.asarray(G[1][0], dtype=np.complex128).reshape(1, n)
+    g11 = np.asarray(G[1][1], dtype=np.complex128).reshape(1, n)
+    for d in range(depth):
+        # LDL decomposition of all the nodes of depth d, as in ldl_fft
+        l10 = div_fft(g10, g00)
+        d00 = g00
+        d11 = sub_fft(g11, mul_fft(mul_fft(l10, adj_fft(l10)), g00))
+        T[d] = l10.reshape(n)
+        # Children 2 * k and 2 * k + 1 come from d00 and d11 of the node k
+        if d + 1 < depth:
+            d0, d1 = split_fft(np.stack([d00, d11], axis=1))
+            rows = 2 << d
+            g00 = g11 = d0.reshape(rows, n // rows)
+            g01 = d1.reshape(rows, n // rows)
+            g10 = adj_fft(g01)
+    # End of the recursion (each element is real)
+    T[depth] = np.stack([d00[:, 0].real, d11[:, 0].real], axis=1).reshape(n)
+    return T
 
 
 def ffnp(t, T):
@@ -162,22 +195,23 @@ def ffnp(t, T):
         return z
 
 
-def ffnp_fft(t, T):
+def ffnp_fft(t, T, depth=0, index=0):
     """Compute the ffnp reduction of t, using T as auxilary information.
 
     Args:
         t: a vector
-        T: a ldl decomposition tree
+        T: a ldl decomposition tree, as returned by ffldl_fft
+        depth, index: the node of T to use (the root by default)
 
     Format: FFT
     """
     n = len(t[0]) * fft_ratio
     z = [0, 0]
     if (n > 1):
-        l10, T0, T1 = T
-        z[1] = merge_fft(ffnp_fft(split_fft(t[1]), T1))
+        l10 = T[depth, index * n:(index + 1) * n]
+        z[1] = merge_fft(ffnp_fft(split_fft(t[1]), T, depth + 1, 2 * index + 1))
         t0b = add_fft(t[0], mul_fft(sub_fft(t[1], z[1]), l10))
-        z[0] = merge_fft(ffnp_fft(split_fft(t0b), T0))
+        z[0] = merge_fft(ffnp_fft(split_fft(t0b), T, depth + 1, 2 * index))
         return z
     elif (n == 1):
         z[0] = [round(t[0][0].real)]
@@ -185,26 +219,170 @@ def ffnp_fft(t, T):
         return z
 
 
-def ffsampling_fft(t, T, sigmin, randombytes):
+def ffsampling_fft(t, T, sigmin, randombytes, depth=0, index=0):
     """Compute the ffsampling of t, using T as auxilary information.
 
     Args:
         t: a vector
-        T: a ldl decomposition tree
+        T: a ldl decomposition tree, as returned by ffldl_fft
+        depth, index: the node of T to use (the root by default)
 
     Format: FFT
 
+    t can hold arrays of polynomials (one per row), in which case the tree is
+    walked once for all of them and z holds arrays of the same shape.
+
     Corresponds to algorithm 11 (ffSampling) of Falcon's documentation.
     """
-    n = len(t[0]) * fft_ratio
+    n = np.shape(t[0])[-1] * fft_ratio
     z = [0, 0]
     if (n > 1):
-        l10, T0, T1 = T
-        z[1] = merge_fft(ffsampling_fft(split_fft(t[1]), T1, sigmin, randombytes))
+        l10 = T[depth, index * n:(index + 1) * n]
+        z[1] = merge_fft(ffsampling_fft(split_fft(t[1]), T, sigmin, randombytes, depth + 1, 2 * index + 1))
         t0b = add_fft(t[0], mul_fft(sub_fft(t[1], z[1]), l10))
-        z[0] = merge_fft(ffsampling_fft(split_fft(t0b), T0, sigmin, randombytes))
+        z[0] = merge_fft(ffsampling_fft(split_fft(t0b), T, sigmin, randombytes, depth + 1, 2 * index))
         return z
     elif (n == 1):
-        z[0] = [samplerz(t[0][0].real, T[0], sigmin, randombytes)]
-        z[1] = [samplerz(t[1][0].real, T[0], sigmin, randombytes)]
+        z[0], z[1] = samplerz_leaf(t, T[depth, index].real, sigmin, randombytes)
         return z
+
+
+# Size of the subtrees that ffsampling_fft_inplace samples with scalar arithmetic, for a
+# single vector: below it, the NumPy calls on 1- or 2-element views cost more than the work
+SCALAR_SIZE = 4
+
+
+def ffsampling_scalar(t0, t1, T, sigmin, randombytes, depth, index):
+    """Compute the ffsampling of (t0, t1) with Python complex numbers, for small polynomials.
+
+    Args:
+        t0, t1: lists of complex numbers
+        T: a ldl decomposition tree, as returned by ffldl_fft
+        depth, index: the node of T to use
+
+    Format: FFT
+
+    Same operations, in the same order, as ffsampling_fft_inplace, so the result is the same.
+    """
+    m = len(t0)
+    if m == 1:
+        sigma = float(T[depth, index].real)
+        return ([samplerz(t0[0].real, sigma, sigmin, randombytes)],
+                [samplerz(t1[0].real, sigma, sigmin, randombytes)])
+    w, _, w_half_conj = scalar_twiddles(m)
+    half = m >> 1
+    # Second child, on the split of t1
+    u0, u1 = ffsampling_scalar([(t1[2 * i] + t1[2 * i + 1]) * 0.5 for i in range(half)],
+                               [(t1[2 * i] - t1[2 * i + 1]) * w_half_conj[i] for i in range(half)],
+                               T, sigmin, randombytes, depth + 1, 2 * index + 1)
+    z1 = merge_scalar(u0, u1, w)
+    # First child, on the split of t0 + (t1 - z1) * l10
+    l10 = T[depth, index * m:(index + 1) * m].tolist()
+    t0b = [t0[i] + (t1[i] - z1[i]) * l10[i] for i in range(m)]
+    u0, u1 = ffsampling_scalar([(t0b[2 * i] + t0b[2 * i + 1]) * 0.5 for i in range(half)],
+                               [(t0b[2 * i] - t0b[2 * i + 1]) * w_half_conj[i] for i in range(half)],
+                               T, sigmin, randombytes, depth + 1, 2 * index)
+    return merge_scalar(u0, u1, w), z1
+
+
+def merge_scalar(f0, f1, w):
+    """Same as merge_fft, for lists of numbers and the twiddle factors w of scalar_twiddles."""
+    f = []
+    for i in range(len(f0)):
+        t = w[i] * f1[i]
+        f += [f0[i] + t, f0[i] - t]
+    return f
+
+
+class SamplingWorkspace:
+    """Preallocated scratch space of ffsampling_fft_inplace.
+
+    It holds, for each depth d of the tree, the vector t = (t0[d], t1[d]) given
+    to the current node of depth d and the vector z = (z0[d], z1[d]) it outputs,
+    all of them views of one buffer. A workspace is meant to be used by one
+    thread at a time, for vectors of polynomials of size n and shape batch + (n,).
+    """
+
+    def __init__(self, n, batch=()):
+        self.n = n
+        self.batch = tuple(batch)
+        self.depth = n.bit_length() - 1
+        self.buffer = np.zeros(self.batch + (4, 2 * n), dtype=np.complex128)
+        # The polynomials of depth d have size n >> d and start at 2 * n - 2 * (n >> d)
+        self.t0, self.t1, self.z0, self.z1 = (
+            [self.buffer[..., i, 2 * n - 2 * (n >> d):2 * n - (n >> d)] for d in range(self.depth + 1)]
+            for i in range(4))
+
+
+def ffsampling_fft_inplace(t, T, sigmin, randombytes, workspace):
+    """Compute the ffsampling of t, using T as auxilary information.
+
+    Args:
+        t: a vector
+        T: a ldl decomposition tree, as returned by ffldl_fft
+        workspace: a SamplingWorkspace of the size and batch shape of t
+
+    Format: FFT
+
+    Iterative version of ffsampling_fft: the tree is walked in the same order
+    (second child first), with the same operations, but all the intermediate
+    values are written in the workspace, so that nothing is allocated.
+    For a single vector, the subtrees of size SCALAR_SIZE are sampled by ffsampling_scalar.
+    The returned z is made of views of the workspace, which are overwritten by
+    the next call using it.
+    """
+    ws = workspace
+    depth = ws.depth
+    if t[0] is not ws.t0[0]:
+        np.copyto(ws.t0[0], t[0])
+    if t[1] is not ws.t1[0]:
+        np.copyto(ws.t1[0], t[1])
+    # Depth of the nodes sampled without going further down
+    bottom = depth if ws.batch else max(depth - (SCALAR_SIZE.bit_length() - 1), 0)
+    d, index = 0, 0
+    while True:
+        # Go down to the bottom, through the second child of each node
+        while d < bottom:
+            split_fft_into(ws.t1[d], ws.t0[d + 1], ws.t1[d + 1])
+            d, index = d + 1, 2 * index + 1
+        if ws.batch:
+            ws.z0[d][...], ws.z1[d][...] = samplerz_leaf(
+                [ws.t0[d], ws.t1[d]], T[d, index].real, sigmin, randombytes)
+        else:
+            ws.z0[d][...], ws.z1[d][...] = ffsampling_scalar(
+                ws.t0[d].tolist(), ws.t1[d].tolist(), T, sigmin, randombytes, d, index)
+        # Go up to the first node whose first child remains to be sampled
+        while d > 0:
+            d, index, child = d - 1, index >> 1, index
+            if child & 1:
+                # The second child gave z1: compute the t of the first child
+                merge_fft_into(ws.z0[d + 1], ws.z1[d + 1], ws.z1[d])
+                size = ws.n >> d
+                t1 = ws.t1[d]
+                np.subtract(t1, ws.z1[d], out=t1)
+                np.multiply(t1, T[d, index * size:(index + 1) * size], out=t1)
+                np.add(ws.t0[d], t1, out=t1)
+                split_fft_into(t1, ws.t0[d + 1], ws.t1[d + 1])
+                d, index = d + 1, child - 1
+                break
+            merge_fft_into(ws.z0[d + 1], ws.z1[d + 1], ws.z0[d])
+        else:
+            return [ws.z0[0], ws.z1[0]]
+
+
+def samplerz_leaf(t, sigma, sigmin, randombytes):
+    """Sample a leaf of the ffsampling, for one vector of polynomials of size 1 or for a batch of them.
+
+    Args:
+        t: a vector of two arrays of shape (..., 1)
+        sigma: the standard deviation stored in the leaf of the tree
+
+    Format: FFT
+    """
+    if np.ndim(t[0]) == 1:
+        return [[samplerz(t[0][0].real, sigma, sigmin, randombytes)],
+                [samplerz(t[1][0].real, sigma, sigmin, randombytes)]]
+    mu = np.stack([np.asarray(t[0]).real, np.asarray(t[1]).real])
+    # Both polynomials of all the vectors are sampled at once
+    z = samplerz_batch(mu, sigma, sigmin, randombytes)
+    return [z[0], z[1]]
@@ -7,89 +7,198 @@ The code is voluntarily very similar to the code of the NTT.
 It is probably possible to use templating to merge both implementations.
 """
 
-from common import split, merge         # Import split and merge
-from fft_constants import roots_dict    # Import constants useful for the FFT
+import numpy as np
+
+
+def _root_exponents(n):
+    """Return the exponents k such that the roots of phi_2n = x ** n + 1 are the exp(2 * i * pi * k / 2048).
+
+    The roots of x ** 2 + 1 are [i, -i]. The roots for 2n are, for each root r for n,
+    its two square roots (s, -s), with s of positive real part first.
+    """
+    if n == 2:
+        return [512, 1536]
+    exponents = []
+    for k in _root_exponents(n // 2):
+        # The square roots of exp(2 * i * pi * k / 2048) have exponents k / 2 and k / 2 + 1024
+        s = k // 2 if (k // 2 + 512) % 2048 < 1024 else k // 2 + 1024
+        exponents += [s, (s + 1024) % 2048]
+    return exponents
+
+
+class RootsDict(dict):
+    """Dictionary of the complex roots of the cyclotomic polynomials, in the order used by the FFT.
+
+    roots_dict[n] is the list of the n roots of phi_2n = x ** n + 1, for n a power of two,
+    2 <= n <= 1024. Each list is computed on first use, and matches the one of fft_constants
+    (up to the precision of the literals there).
+    """
+
+    def __missing__(self, n):
+        if n < 2 or n > 1024 or n & (n - 1):
+            raise KeyError(n)
+        k = np.array(_root_exponents(n))
+        # exp(2 * i * pi * k / 2048) = i ** (k // 512) * exp(2 * i * pi * (k % 512) / 2048), and the
+        # multiplication by a power of i is exact
+        r = k % 512
+        roots = np.cos(np.pi * r / 1024) + 1j * np.sin(np.pi * r / 1024)
+        roots *= np.array([1, 1j, -1, -1j])[k // 512]
+        self[n] = roots.tolist()
+        return self[n]
+
+
+roots_dict = RootsDict()
+
+
+"""Cache of the twiddle factors, indexed by the size of the merged polynomial."""
+_twiddles = {}
+_scalar_twiddles = {}
+
+
+def _roots(n):
+    """Return the twiddle factors (w, conj(w), conj(w) / 2) used to merge/split polynomials of size n.
+
+    w[i] is the root roots_dict[n][2 * i], the only ones used by merge_fft and split_fft.
+    Halving is exact, so multiplying by conj(w) / 2 gives the same result as
+    multiplying by 0.5 and then by conj(w).
+    """
+    if n not in _twiddles:
+        w = np.array(roots_dict[n][0::2], dtype=np.complex128)
+        _twiddles[n] = (w, w.conj(), 0.5 * w.conj())
+    return _twiddles[n]
+
+
+def scalar_twiddles(n):
+    """Return the twiddle factors of _roots(n), as lists of Python complex numbers.
+
+    They are meant for code working on polynomials too small for NumPy to pay off.
+    """
+    if n not in _scalar_twiddles:
+        _scalar_twiddles[n] = tuple(roots.tolist() for roots in _roots(n))
+    return _scalar_twiddles[n]
 
 
 def split_fft(f_fft):
     """Split a polynomial f in two polynomials.
 
     Args:
-        f: a polynomial
+        f: a polynomial (or an array of polynomials, along the last axis)
 
     Format: FFT
 
     Corresponds to algorithm 1 (splitfft_2) of Falcon's documentation.
     """
-    n = len(f_fft)
-    w = roots_dict[n]
-    f0_fft = [0] * (n // 2)
-    f1_fft = [0] * (n // 2)
-    for i in range(n // 2):
-        f0_fft[i] = 0.5 * (f_fft[2 * i] + f_fft[2 * i + 1])
-        f1_fft[i] = 0.5 * (f_fft[2 * i] - f_fft[2 * i + 1]) * w[2 * i].conjugate()
+    f_fft = np.asarray(f_fft, dtype=np.complex128)
+    n = f_fft.shape[-1]
+    w_half_conj = _roots(n)[2]
+    even, odd = f_fft[..., 0::2], f_fft[..., 1::2]
+    f0_fft = 0.5 * (even + odd)
+    f1_fft = (even - odd) * w_half_conj
     return [f0_fft, f1_fft]
 
 
+def split_fft_into(f_fft, f0_fft, f1_fft):
+    """Same as split_fft, writing the two polynomials into the preallocated arrays f0_fft and f1_fft.
+
+    Format: FFT
+    """
+    w_half_conj = _roots(f_fft.shape[-1])[2]
+    even, odd = f_fft[..., 0::2], f_fft[..., 1::2]
+    np.add(even, odd, out=f0_fft)
+    f0_fft *= 0.5
+    np.subtract(even, odd, out=f1_fft)
+    f1_fft *= w_half_conj
+
+
 def merge_fft(f_list_fft):
     """Merge two or three polynomials into a single polynomial f.
 
     Args:
-        f_list: a list of polynomials
+        f_list: a list of polynomials (or of arrays of polynomials)
 
     Format: FFT
 
     Corresponds to algorithm 2 (mergefft_2) of Falcon's documentation.
     """
-    f0_fft, f1_fft = f_list_fft
-    n = 2 * len(f0_fft)
-    w = roots_dict[n]
-    f_fft = [0] * n
-    for i in range(n // 2):
-        f_fft[2 * i + 0] = f0_fft[i] + w[2 * i] * f1_fft[i]
-        f_fft[2 * i + 1] = f0_fft[i] - w[2 * i] * f1_fft[i]
+    f0_fft = np.asarray(f_list_fft[0], dtype=np.complex128)
+    f1_fft = np.asarray(f_list_fft[1], dtype=np.complex128)
+    n = 2 * f0_fft.shape[-1]
+    w = _roots(n)[0]
+    t = w * f1_fft
+    f_fft = np.empty(t.shape[:-1] + (n,), dtype=np.complex128)
+    np.add(f0_fft, t, out=f_fft[..., 0::2])
+    np.subtract(f0_fft, t, out=f_fft[..., 1::2])
     return f_fft
 
 
+def merge_fft_into(f0_fft, f1_fft, f_fft):
+    """Same as merge_fft, writing the merged polynomial into the preallocated array f_fft.
+
+    f1_fft is overwritten (it is used as scratch space).
+
+    Format: FFT
+    """
+    np.multiply(_roots(f_fft.shape[-1])[0], f1_fft, out=f1_fft)
+    np.add(f0_fft, f1_fft, out=f_fft[..., 0::2])
+    np.subtract(f0_fft, f1_fft, out=f_fft[..., 1::2])
+
+
 def fft(f):
     """Compute the FFT of a polynomial mod (x ** n + 1).
 
     Args:
-        f: a polynomial
+        f: a polynomial (or an array of polynomials, along the last axis)
 
     Format: input as coefficients, output as FFT
+
+    This is the iterative version of the recursion f -> merge_fft(fft(f0), fft(f1)).
+    At each step, row j of the working array holds the FFT of the sub-polynomial
+    f[j::rows]: rows j and j + rows/2 are the even and odd halves of row j of the
+    next level, so no bit-reversal permutation is needed.
     """
-    n = len(f)
-    if (n > 2):
-        f0, f1 = split(f)
-        f0_fft = fft(f0)
-        f1_fft = fft(f1)
-        f_fft = merge_fft([f0_fft, f1_fft])
-    elif (n == 2):
-        f_fft = [0] * n
-        f_fft[0] = f[0] + 1j * f[1]
-        f_fft[1] = f[0] - 1j * f[1]
-    return f_fft
+    f = np.asarray(f, dtype=np.complex128)
+    batch, n = f.shape[:-1], f.shape[-1]
+    a = f.reshape(batch + (n, 1))
+    rows, m = n, 1
+    while rows > 1:
+        rows //= 2
+        w = _roots(2 * m)[0]
+        t = a[..., rows:, :] * w
+        b = np.empty(batch + (rows, 2 * m), dtype=np.complex128)
+        np.add(a[..., :rows, :], t, out=b[..., 0::2])
+        np.subtract(a[..., :rows, :], t, out=b[..., 1::2])
+        a, m = b, 2 * m
+    return a.reshape(batch + (n,))
 
 
 def ifft(f_fft):
     """Compute the inverse FFT of a polynomial mod (x ** n + 1).
 
     Args:
-        f: a FFT of a polynomial
+        f: a FFT of a polynomial (or an array of them, along the last axis)
 
     Format: input as FFT, output as coefficients
+
+    This is the iterative version of the recursion f_fft -> merge(ifft(f0_fft), ifft(f1_fft)),
+    using the same row layout as fft.
     """
-    n = len(f_fft)
-    if (n > 2):
-        f0_fft, f1_fft = split_fft(f_fft)
-        f0 = ifft(f0_fft)
-        f1 = ifft(f1_fft)
-        f = merge([f0, f1])
-    elif (n == 2):
-        f = [0] * n
-        f[0] = f_fft[0].real
-        f[1] = f_fft[0].imag
+    f_fft = np.asarray(f_fft, dtype=np.complex128)
+    batch, n = f_fft.shape[:-1], f_fft.shape[-1]
+    a = f_fft.reshape(batch + (1, n))
+    rows, m = 1, n
+    while m > 2:
+        w_half_conj = _roots(m)[2]
+        even, odd = a[..., 0::2], a[..., 1::2]
+        b = np.empty(batch + (2 * rows, m // 2), dtype=np.complex128)
+        np.add(even, odd, out=b[..., :rows, :])
+        b[..., :rows, :] *= 0.5
+        np.subtract(even, odd, out=b[..., rows:, :])
+        b[..., rows:, :] *= w_half_conj
+        a, rows, m = b, 2 * rows, m // 2
+    # Row j now holds the FFT of the polynomial (f[j], f[j + rows]) of degree 2
+    f = np.empty(batch + (n,), dtype=np.float64)
+    f[..., :rows] = a[..., 0].real
+    f[..., rows:] = a[..., 0].imag
     return f
 
 
@@ -128,31 +237,27 @@ def adj(f):
 
 def add_fft(f_fft, g_fft):
     """Addition of two polynomials (FFT representation)."""
-    return add(f_fft, g_fft)
+    return np.add(f_fft, g_fft)
 
 
 def sub_fft(f_fft, g_fft):
     """Substraction of two polynomials (FFT representation)."""
-    return sub(f_fft, g_fft)
+    return np.subtract(f_fft, g_fft)
 
 
 def mul_fft(f_fft, g_fft):
     """Multiplication of two polynomials (coefficient representation)."""
-    deg = len(f_fft)
-    return [f_fft[i] * g_fft[i] for i in range(deg)]
+    return np.multiply(f_fft, g_fft)
 
 
 def div_fft(f_fft, g_fft):
     """Division of two polynomials (FFT representation)."""
-    assert len(f_fft) == len(g_fft)
-    deg = len(f_fft)
-    return [f_fft[i] / g_fft[i] for i in range(deg)]
+    return np.divide(f_fft, g_fft)
 
 
 def adj_fft(f_fft):
     """Ajoint of a polynomial (FFT representation)."""
-    deg = len(f_fft)
-    return [f_fft[i].conjugate() for i in range(deg)]
+    return np.conjugate(f_fft)
 
 
 """This value is the ratio between:
@@ -0,0 +1,168 @@
+"""
+Pool of pre-generated Falcon secret keys.
+Generating a SecretKey (NTRUGen, LDL tree) takes far longer than handing one out,
+so a KeyPool keeps ready-made keys for each degree n and refills itself in the
+background with a process pool:
+- when the number of ready keys for n drops below low_water, enough key
+  generations are started to bring it back to high_water
+- get(n) pops a ready key, which is O(1) as long as the pool is not empty
+If a directory is given, each ready key is also written to its own file there
+(in the format of SecretKey.to_bytes), so that the pool survives restarts. A key handed out by get is removed from disk,
+so that it is never handed out twice, even by several processes sharing the directory.
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty
+from threading import Condition
+from falcon import SecretKey
+
+
+def generate_key(n):
+    """Generate a SecretKey of degree n. Run in the worker processes."""
+    return SecretKey(n)
+
+
+class KeyPool:
+
+    def __init__(self, degrees=(256,), low_water=4, high_water=16, workers=None, directory=None):
+        """
+        Initialize the pool for the given degrees, load the keys saved in
+        directory (if any) and start generating the missing ones.
+        """
+        if not 0 <= low_water <= high_water:
+            raise ValueError("The water marks must satisfy 0 <= low_water <= high_water")
+        self.low_water = low_water
+        self.high_water = high_water
+        self.directory = directory
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.condition = Condition()
+        # For each degree: the ready keys, with the path of their file (or None),
+        # and the number of keys being generated
+        self.keys = {n: deque() for n in degrees}
+        self.in_flight = {n: 0 for n in degrees}
+        self.errors = {n: None for n in degrees}
+        self.generated = 0
+        self.closed = False
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+        with self.condition:
+            for n in degrees:
+                self.refill(n)
+
+    def __repr__(self):
+        sizes = ", ".join(f"{n}: {len(keys)} (+{self.in_flight[n]})" for n, keys in self.keys.items())
+        return f"KeyPool({{{sizes}}}, low_water={self.low_water}, high_water={self.high_water})"
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+    def size(self, n):
+        """Number of keys of degree n ready to be handed out."""
+        return len(self.keys[n])
+
+    def load(self):
+        """Load the keys saved in the directory, for the degrees of the pool."""
+        for name in sorted(os.listdir(self.directory)):
+            prefix, _, suffix = name.partition("-")
+            if not (prefix.isdigit() and int(prefix) in self.keys and suffix.endswith(".key")):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "rb") as file:
+                    sk = SecretKey.from_bytes(file.read())
+            except (OSError, ValueError):
+                # Not a valid key file: it is left on disk, but never handed out
+                continue
+            if sk.n != int(prefix):
+                continue
+            self.keys[sk.n].append((sk, path))
+
+    def save(self, sk):
+        """Write sk to its own file in the directory, readable by the owner only, and return its path."""
+        path = os.path.join(self.directory, f"{sk.n}-{os.urandom(8).hex()}.key")
+        # The key only appears under its final name once it is completely written
+        sk.save(path, exclusive=True)
+        return path
+
+    def claim(self, path):
+        """
+        Remove the key file at path, and return True, unless another process
+        sharing the directory claimed it first. The file is renamed first, which
+        only one process can do.
+        """
+        claimed = f"{path}.{os.urandom(8).hex()}.claimed"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return False
+        os.remove(claimed)
+        return True
+
+    def refill(self, n):
+        """
+        If fewer than low_water keys of degree n are ready or being generated,
+        start generating keys up to high_water. Must be called with the condition held.
+        """
+        if self.closed:
+            return
+        available = len(self.keys[n]) + self.in_flight[n]
+        if available >= self.low_water and available > 0:
+            return
+        for _ in range(max(self.high_water - available, 1)):
+            future = self.executor.submit(generate_key, n)
+            self.in_flight[n] += 1
+            future.add_done_callback(lambda future, n=n: self.collect(n, future))
+
+    def collect(self, n, future):
+        """Store the key generated by future, and wake up the callers of get waiting for one."""
+        try:
+            sk = future.result()
+            path = self.save(sk) if self.directory is not None else None
+        except Exception as error:
+            sk = None
+            with self.condition:
+                self.errors[n] = error
+        with self.condition:
+            self.in_flight[n] -= 1
+            if sk is not None:
+                self.keys[n].append((sk, path))
+                self.generated += 1
+                self.errors[n] = None
+            self.condition.notify_all()
+
+    def get(self, n, block=True, timeout=None):
+        """
+        Return a ready SecretKey of degree n, and refill the pool if needed.
+        If no key is ready, wait for one if block is True (at most timeout seconds),
+        otherwise raise queue.Empty, as Queue.get does.
+        """
+        if n not in self.keys:
+            raise ValueError(f"The pool does not hold keys of degree {n}")
+        while True:
+            with self.condition:
+                self.refill(n)
+                if block:
+                    ready = self.condition.wait_for(lambda: self.keys[n] or self.in_flight[n] == 0, timeout)
+                if not self.keys[n]:
+                    if block and ready and self.errors[n] is not None:
+                        raise RuntimeError(f"Key generation failed for n = {n}") from self.errors[n]
+                    raise Empty
+                sk, path = self.keys[n].popleft()
+                self.refill(n)
+            # A key loaded from the directory may have been handed out by another process
+            if path is None or self.claim(path):
+                return sk
+
+    def close(self, wait=True):
+        """Stop generating keys. The keys saved in the directory are kept for the next start."""
+        with self.condition:
+            self.closed = True
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,12 +1,20 @@
-from fastapi import FastAPI, HTTPException, Form
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Form, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from cryptography.fernet import Fernet
-from falcon import PublicKey, SecretKey
-from typing import Optional
+from falcon import PublicKey, SecretKey, PointHasher, random_pool, SALT_BYTES, HEAD_LENGTH
+from keypool import KeyPool
+from signing_pool import SigningPool, PoolOverloaded, generate_key, sign, verify, sign_many, verify_many
+from signing_pool import sign_encoded, verify_encoded, sign_hashed, verify_hashed
+from wire import MEDIA_TYPES, WireError, encode_fields
+from typing import Optional, List
+from queue import Empty
 import os
+import shutil
 import hashlib
+import json
 from cryptography.fernet import Fernet
 import time
 
@@ -15,15 +23,96 @@ users = {}
 # Store session tokens
 sessions = {}
 
+# Configuration, from the environment
+# - FALCON_WORKERS: number of processes running the Falcon operations (default: one per CPU)
+# - FALCON_MAX_PENDING: number of operations pending at once, beyond which requests
+#   are answered with 503 (default: 8 per worker)
+# - FALCON_KEY_DIR: directory of the secret key files read by the workers. The keys of
+#   the users registered by a process of the service are in users/<pid>, removed with it.
+FALCON_WORKERS = int(os.environ.get("FALCON_WORKERS", 0)) or None
+FALCON_MAX_PENDING = int(os.environ.get("FALCON_MAX_PENDING", 0)) or None
+FALCON_KEY_DIR = os.environ.get("FALCON_KEY_DIR", os.path.join(os.path.dirname(__file__), "keys"))
+
+# Batch endpoints: messages per batch, and per task sent to a worker
+MAX_BATCH_SIZE = 10000
+BATCH_CHUNK_SIZE = 64
+NDJSON = "application/x-ndjson"
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# Initialize cryptographic keys
+# Falcon operations run in worker processes, which keep the keys in memory
+signing_pool = SigningPool(FALCON_WORKERS, FALCON_MAX_PENDING)
+
+# Cryptographic keys of the service: the secret key stays in a file read by the workers,
+# and the public key is also kept serialized, as sent to them
 falcon_keys = {
-    "user_sk": SecretKey(256),
-    "user_pk": None
+    "user_sk_path": os.path.join(FALCON_KEY_DIR, "service.key"),
+    "user_pk": None,
+    "user_pk_bytes": None
 }
-falcon_keys["user_pk"] = PublicKey(falcon_keys["user_sk"])
+
+# Ready-made user keys, generated in the background and saved across restarts
+key_pool = KeyPool(degrees=(256,), low_water=4, high_water=16,
+                   directory=os.path.join(os.path.dirname(__file__), "keypool"))
+
+def user_key_directory():
+    """Directory of the secret keys of the users registered by this process."""
+    return os.path.join(FALCON_KEY_DIR, "users", str(os.getpid()))
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def remove_stale_user_keys():
+    """
+    Remove the user keys left by the processes of the service which are no longer running:
+    the users only live in the memory of the process which registered them.
+    """
+    directory = os.path.join(FALCON_KEY_DIR, "users")
+    for name in os.listdir(directory):
+        if name.isdigit() and process_running(int(name)):
+            continue
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+@app.on_event("startup")
+async def load_service_key():
+    os.makedirs(user_key_directory(), exist_ok=True)
+    remove_stale_user_keys()
+    path = falcon_keys["user_sk_path"]
+    if not os.path.exists(path):
+        try:
+            await signing_pool.run(generate_key, 256, path)
+        except FileExistsError:
+            # Another process of the service (uvicorn --workers) created the key first
+            pass
+    # The public key is read from the file, whichever process wrote it
+    falcon_keys["user_pk"] = PublicKey(SecretKey.load(path))
+    falcon_keys["user_pk_bytes"] = falcon_keys["user_pk"].to_bytes()
+
+@app.on_event("shutdown")
+def close_pools():
+    key_pool.close(wait=False)
+    signing_pool.close(wait=False)
+    # The users registered by this process are gone with it
+    shutil.rmtree(user_key_directory(), ignore_errors=True)
+
+@app.exception_handler(PoolOverloaded)
+async def overloaded(request: Request, exc: PoolOverloaded):
+    return JSONResponse(status_code=503, content={"detail": "Server overloaded, retry later."},
+                        headers={"Retry-After": "1"})
 
 # Define the request models
 
@@ -38,6 +127,13 @@ class RegisterRequest(BaseModel):
     user_id: str
     password: str
 
+class SignBatchRequest(BaseModel):
+    messages: List[str]
+
+class VerifyBatchRequest(BaseModel):
+    messages: List[str]
+    signatures: List[str]
+
 class AuthenticateRequest(BaseModel):
     user_id: str
     password: str
@@ -55,16 +151,166 @@ async def home():
 
 @app.post("/sign")
 async def sign_message(request: SignMessageRequest):
-    sk = falcon_keys["user_sk"]
-    signature = sk.sign(request.message.encode("utf-8"))
+    signature = await signing_pool.run(sign, falcon_keys["user_sk_path"], request.message.encode("utf-8"))
     return {"message": request.message, "signature": signature.hex()}
 
 @app.post("/verify")
 async def verify_message(request: VerifyRequest):
-    pk = falcon_keys["user_pk"]
-    is_valid = pk.verify(request.message.encode("utf-8"), bytes.fromhex(request.signature))
+    is_valid = await signing_pool.run(verify, falcon_keys["user_pk_bytes"], request.message.encode("utf-8"),
+                                      bytes.fromhex(request.signature))
     return {"message": request.message, "is_valid": is_valid}
 
+def check_batch_size(size):
+    if size > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_SIZE} items per batch.")
+
+def chunks(items):
+    return [items[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(items), BATCH_CHUNK_SIZE)]
+
+async def batch_response(request, results, window):
+    """
+    Answer a batch request with the results yielded by the async generator results,
+    each a list of JSON objects (one per item): as a stream of NDJSON lines if the client
+    accepts it, as a single JSON object {"results": [...]} otherwise.
+    """
+    # Check the capacity before answering, as a streamed response cannot become a 503
+    signing_pool.check(window)
+    if NDJSON in request.headers.get("accept", ""):
+        async def lines():
+            async for chunk in results:
+                yield "".join(json.dumps(item) + "\n" for item in chunk)
+        return StreamingResponse(lines(), media_type=NDJSON)
+    return {"results": [item async for chunk in results for item in chunk]}
+
+@app.post("/sign-batch")
+async def sign_batch(batch: SignBatchRequest, request: Request):
+    """Sign a batch of messages with the key of the service, BATCH_CHUNK_SIZE messages per worker task."""
+    check_batch_size(len(batch.messages))
+    messages = [message.encode("utf-8") for message in batch.messages]
+    tasks = [(falcon_keys["user_sk_path"], chunk) for chunk in chunks(messages)]
+
+    async def results():
+        index = 0
+        async for signatures in signing_pool.map(sign_many, tasks):
+            chunk = [{"index": index + i, "signature": signature.hex()} for i, signature in enumerate(signatures)]
+            index += len(signatures)
+            yield chunk
+
+    return await batch_response(request, results(), min(signing_pool.workers, len(tasks)))
+
+@app.post("/verify-batch")
+async def verify_batch(batch: VerifyBatchRequest, request: Request):
+    """Verify a batch of (message, signature) pairs against the key of the service."""
+    if len(batch.messages) != len(batch.signatures):
+        raise HTTPException(status_code=400, detail="messages and signatures must have the same length.")
+    check_batch_size(len(batch.messages))
+    messages = [message.encode("utf-8") for message in batch.messages]
+    signatures = []
+    malformed = set()
+    for i, signature in enumerate(batch.signatures):
+        try:
+            signatures.append(bytes.fromhex(signature))
+        except ValueError:
+            signatures.append(b"")
+            malformed.add(i)
+    public_key = falcon_keys["user_pk_bytes"]
+    tasks = [(public_key, message_chunk, signature_chunk)
+             for message_chunk, signature_chunk in zip(chunks(messages), chunks(signatures))]
+
+    async def results():
+        index = 0
+        async for valid, reasons in signing_pool.map(verify_many, tasks):
+            chunk = []
+            for is_valid, reason in zip(valid, reasons):
+                if index in malformed:
+                    reason = "malformed hex signature"
+                chunk.append({"index": index, "is_valid": is_valid, "reason": reason})
+                index += 1
+            yield chunk
+
+    return await batch_response(request, results(), min(signing_pool.workers, len(tasks)))
+
+def wire_media_types(request):
+    """
+    Return the media types of the body of a binary request and of its response:
+    the response is in the first binary media type accepted by the client, if any,
+    otherwise in the media type of the request.
+    """
+    media_type = request.headers.get("content-type", "").partition(";")[0].strip().lower()
+    if media_type not in MEDIA_TYPES:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(MEDIA_TYPES)}.")
+    accept = request.headers.get("accept", "")
+    response_type = next((accepted for accepted in MEDIA_TYPES if accepted in accept), media_type)
+    return media_type, response_type
+
+async def run_wire(function, *args):
+    try:
+        return await signing_pool.run(function, *args)
+    except WireError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+@app.post("/wire/sign")
+async def sign_wire(request: Request):
+    """
+    Sign a message sent in a binary body (see wire): a single frame, or a CBOR map {"message": ...}.
+    The body is decoded in the worker, and the response holds the raw signature.
+    """
+    media_type, response_type = wire_media_types(request)
+    body = await request.body()
+    signature = await run_wire(sign_encoded, falcon_keys["user_sk_path"], body, media_type)
+    return Response(encode_fields({"signature": signature}, response_type), media_type=response_type)
+
+@app.post("/wire/verify")
+async def verify_wire(request: Request):
+    """
+    Verify a message and its signature sent in a binary body (see wire): two frames,
+    or a CBOR map {"message": ..., "signature": ...}.
+    """
+    media_type, response_type = wire_media_types(request)
+    body = await request.body()
+    is_valid = await run_wire(verify_encoded, falcon_keys["user_pk_bytes"], body, media_type)
+    return Response(encode_fields({"is_valid": is_valid}, response_type), media_type=response_type)
+
+async def hash_body(request, salt):
+    """
+    Hash the body of request with salt (see falcon.PointHasher) as its chunks arrive,
+    and return the point and the size of the body. The chunks are hashed in threads,
+    so that large bodies do not hold up the event loop.
+    """
+    hasher = PointHasher(salt, falcon_keys["user_pk"].n)
+    size = 0
+    async for chunk in request.stream():
+        await run_in_threadpool(hasher.update, chunk)
+        size += len(chunk)
+    return await run_in_threadpool(hasher.digest), size
+
+@app.post("/stream/sign")
+async def sign_stream(request: Request):
+    """
+    Sign the raw request body, of any size: it is hashed as it is received (chunked or not),
+    and only the resulting point is sent to the pool, so the memory use does not depend on its size.
+    """
+    # Refuse before reading a possibly large body
+    signing_pool.check()
+    salt = bytes(random_pool(SALT_BYTES))
+    hashed, size = await hash_body(request, salt)
+    signature = await signing_pool.run(sign_hashed, falcon_keys["user_sk_path"], hashed, salt)
+    return {"size": size, "signature": signature.hex()}
+
+@app.post("/stream/verify")
+async def verify_stream(request: Request):
+    """Verify the signature given in hex in the X-Signature header against the raw request body, hashed as in /stream/sign."""
+    try:
+        signature = bytes.fromhex(request.headers.get("x-signature", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Signature must be a hex encoded signature.")
+    if len(signature) < HEAD_LENGTH + SALT_BYTES:
+        raise HTTPException(status_code=400, detail="X-Signature is too short.")
+    signing_pool.check()
+    hashed, size = await hash_body(request, signature[HEAD_LENGTH:HEAD_LENGTH + SALT_BYTES])
+    is_valid = await signing_pool.run(verify_hashed, falcon_keys["user_pk_bytes"], hashed, signature)
+    return {"size": size, "is_valid": is_valid}
+
 @app.post("/register")
 async def register_user(request: RegisterRequest):
     if request.user_id in users:
@@ -72,12 +318,19 @@ async def register_user(request: RegisterRequest):
     
     # Hash the password for secure storage
     password_hash = hashlib.sha256(request.password.encode()).hexdigest()
-    sk = SecretKey(256)
+    try:
+        sk = key_pool.get(256, block=False)
+    except Empty:
+        # The pool ran dry: wait for the next key without blocking the event loop
+        sk = await run_in_threadpool(key_pool.get, 256)
+    # The secret key is saved for the workers, under a fresh name (key files are never overwritten)
+    sk_path = os.path.join(user_key_directory(), os.urandom(16).hex() + ".key")
+    await run_in_threadpool(sk.save, sk_path, exclusive=True)
     users[request.user_id] = {
         "password_hash": password_hash,
         "key_pair": {
-            "sk": sk,
-            "pk": PublicKey(sk)
+            "sk_path": sk_path,
+            "pk_bytes": PublicKey(sk).to_bytes()
         }
     }
     return {"success": f"User {request.user_id} registered successfully."}
@@ -94,11 +347,11 @@ async def authenticate_user(request: AuthenticateRequest):
     password_match = password_hash == user["password_hash"]
 
     # Step 2: Perform Falcon signing and verification
-    sk = user["key_pair"]["sk"]
-    pk = user["key_pair"]["pk"]
+    sk_path = user["key_pair"]["sk_path"]
+    pk_bytes = user["key_pair"]["pk_bytes"]
 
-    signature = sk.sign(request.auth_message.encode("utf-8"))
-    is_valid = pk.verify(request.auth_message.encode("utf-8"), signature)
+    signature = await signing_pool.run(sign, sk_path, request.auth_message.encode("utf-8"))
+    is_valid = await signing_pool.run(verify, pk_bytes, request.auth_message.encode("utf-8"), signature)
 
     # Step 3: Generate Session Key if Password Matches
     session_key = None
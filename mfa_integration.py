@@ -1,13 +1,29 @@
 import hashlib
 import json
 from cryptography.fernet import Fernet
-from falcon import PublicKey, SecretKey
+from falcon import PublicKey
+from keypool import KeyPool
 
 class MFAIntegration:
-    def __init__(self):
+    def __init__(self, key_pool=None):
         self.keys = {}
-        self.secret_key = SecretKey(256)  # FALCON Secret Key
-        self.public_key = PublicKey(self.secret_key)
+        # Pool of ready-made FALCON secret keys, one per user.
+        # A pool created here is closed by close; a pool given by the caller is left to it.
+        self.owns_key_pool = key_pool is None
+        self.key_pool = KeyPool(degrees=(256,)) if key_pool is None else key_pool
+
+    def close(self):
+        """
+        Stop generating keys in the background, if the pool was created by this object.
+        """
+        if self.owns_key_pool:
+            self.key_pool.close(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def register_user(self, user_id, password):
         """
@@ -19,10 +35,13 @@ class MFAIntegration:
         # Hash the password for secure storage
         password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
 
+        # Take a fresh key pair from the pool
+        secret_key = self.key_pool.get(256)
+
         # Save keys and password hash
         self.keys[user_id] = {
-            "public_key": self.public_key,
-            "private_key": self.secret_key,
+            "public_key": PublicKey(secret_key),
+            "private_key": secret_key,
             "password_hash": password_hash,
         }
         return "User registered successfully."
@@ -65,14 +84,14 @@ class MFAIntegration:
 
 # Usage Example
 if __name__ == "__main__":
-    mfa_system = MFAIntegration()
-
-    # Register a user
-    print(mfa_system.register_user("user123", "securepassword"))
+    # Closing stops generating keys in the background
+    with MFAIntegration() as mfa_system:
+        # Register a user
+        print(mfa_system.register_user("user123", "securepassword"))
 
-    # Authenticate user
-    message = "Login request"
-    print(mfa_system.authenticate_user("user123", "securepassword", message))
+        # Authenticate user
+        message = "Login request"
+        print(mfa_system.authenticate_user("user123", "securepassword", message))
 
-    # Generate a session token
-    print(mfa_system.generate_token("user123"))
+        # Generate a session token
+        print(mfa_system.generate_token("user123"))
@@ -2,39 +2,73 @@
 Implementation of NTRU polynomial generation
 """
 from fft import fft, ifft, add_fft, mul_fft, adj_fft, div_fft
-from fft import add, mul, div, adj
 from ntt import ntt
 from common import square_norm
-from samplerz import samplerz
+from samplerz import samplerz_batch
+from rng import RandomPool
+import os
+from os import urandom
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import Counter
+import argparse
+import json
+import sys
+import numpy as np
 
 # Modulus used in NTRU calculations
 q = 12 * 1024 + 1
 
-def poly_multiply_karatsuba(a, b, n):
-    if n == 1:
-        return [a[0] * b[0], 0]
-    else:
-        mid = n // 2
-        a0, a1 = a[:mid], a[mid:]
-        b0, b1 = b[:mid], b[mid:]
-        sum_a = [a0[i] + a1[i] for i in range(mid)]
-        sum_b = [b0[i] + b1[i] for i in range(mid)]
-        product_a0b0 = poly_multiply_karatsuba(a0, b0, mid)
-        product_a1b1 = poly_multiply_karatsuba(a1, b1, mid)
-        product_sum = poly_multiply_karatsuba(sum_a, sum_b, mid)
-        for i in range(n):
-            product_sum[i] -= product_a0b0[i] + product_a1b1[i]
-        result = [0] * (2 * n)
-        for i in range(n):
-            result[i] += product_a0b0[i]
-            result[i + n] += product_a1b1[i]
-            result[i + mid] += product_sum[i]
-        return result
+# Length of the seeds of the workers of ntru_gen_many
+SEED_BYTES = 56
 
-def karatsuba_reduction(a, b):
+# Number of keys generated by one task of ntru_gen_many
+KEYS_PER_TASK = 8
+
+def max_bitsize(a):
+    """Return the largest bit size of the absolute values of the coefficients of a."""
+    return max(abs(x).bit_length() for x in a)
+
+def kronecker_pack(a, width):
+    """
+    Evaluate the polynomial a at 2 ** width, for a width multiple of 8 and
+    coefficients of absolute value below 2 ** (width - 1).
+    Each coefficient is shifted by 2 ** (width - 1) to be written in base 2 ** width.
+    """
+    offset = 1 << (width - 1)
+    nbytes = width >> 3
+    packed = b"".join((x + offset).to_bytes(nbytes, "little") for x in a)
+    ones = (b"\x01" + bytes(nbytes - 1)) * len(a)
+    return int.from_bytes(packed, "little") - offset * int.from_bytes(ones, "little")
+
+def kronecker_unpack(value, width, length):
+    """
+    Inverse of kronecker_pack: return the length coefficients of the polynomial
+    whose evaluation at 2 ** width is value.
+    """
+    offset = 1 << (width - 1)
+    nbytes = width >> 3
+    ones = (b"\x01" + bytes(nbytes - 1)) * length
+    packed = (value + offset * int.from_bytes(ones, "little")).to_bytes(length * nbytes, "little")
+    return [int.from_bytes(packed[i * nbytes:(i + 1) * nbytes], "little") - offset for i in range(length)]
+
+def kronecker_reduction(a, b):
+    """
+    Multiply a and b mod (x ** n + 1), for polynomials with arbitrarily large integer coefficients.
+    Kronecker substitution turns the product of polynomials into a single product of
+    (large) integers, which Python computes natively.
+    """
     n = len(a)
-    ab = poly_multiply_karatsuba(a, b, n)
-    return [ab[i] - ab[i + n] for i in range(n)]
+    # Each coefficient of a * b mod (x ** n + 1) is a sum of n products, minus a sum of n products
+    width = max_bitsize(a) + max_bitsize(b) + n.bit_length() + 2
+    width = (width + 7) & ~7
+    packed_a = kronecker_pack(a, width)
+    packed_ab = packed_a * packed_a if a is b else packed_a * kronecker_pack(b, width)
+    # Split a * b = low + x ** n * high, then reduce: a * b = low - high mod (x ** n + 1)
+    low = packed_ab & ((1 << (width * n)) - 1)
+    if low >> (width * n - 1):
+        low -= 1 << (width * n)
+    high = (packed_ab - low) >> (width * n)
+    return kronecker_unpack(low - high, width, n)
 
 def conjugate_galois(a):
     n = len(a)
@@ -44,8 +78,8 @@ def norm_field(a):
     n_half = len(a) // 2
     even_terms = [a[2 * i] for i in range(n_half)]
     odd_terms = [a[2 * i + 1] for i in range(n_half)]
-    squared_even = karatsuba_reduction(even_terms, even_terms)
-    squared_odd = karatsuba_reduction(odd_terms, odd_terms)
+    squared_even = kronecker_reduction(even_terms, even_terms)
+    squared_odd = kronecker_reduction(odd_terms, odd_terms)
     result = squared_even[:]
     for i in range(n_half - 1):
         result[i + 1] -= squared_odd[i]
@@ -60,12 +94,8 @@ def poly_lift(a):
     return result
 
 def bitsize_value(a):
-    abs_a = abs(a)
-    bits = 0
-    while abs_a:
-        bits += 8
-        abs_a >>= 8
-    return bits
+    # Bit size of a, rounded up to a multiple of 8
+    return (abs(a).bit_length() + 7) & ~7
 
 def babai_reduction(f, g, F, G):
     n = len(f)
@@ -74,6 +104,7 @@ def babai_reduction(f, g, F, G):
     adjusted_g = [x >> (adjusted_size - 53) for x in g]
     fft_f = fft(adjusted_f)
     fft_g = fft(adjusted_g)
+    denominator_fft = add_fft(mul_fft(fft_f, adj_fft(fft_f)), mul_fft(fft_g, adj_fft(fft_g)))
     while True:
         current_size = max(53, bitsize_value(min(F)), bitsize_value(max(F)), bitsize_value(min(G)), bitsize_value(max(G)))
         if current_size < adjusted_size:
@@ -82,14 +113,13 @@ def babai_reduction(f, g, F, G):
         adjusted_G = [x >> (current_size - 53) for x in G]
         fft_F = fft(adjusted_F)
         fft_G = fft(adjusted_G)
-        denominator_fft = add_fft(mul_fft(fft_f, adj_fft(fft_f)), mul_fft(fft_g, adj_fft(fft_g)))
         numerator_fft = add_fft(mul_fft(fft_F, adj_fft(fft_f)), mul_fft(fft_G, adj_fft(fft_g)))
         k_fft = div_fft(numerator_fft, denominator_fft)
         k = [int(round(x)) for x in ifft(k_fft)]
         if all(x == 0 for x in k):
             break
-        poly_k_f = karatsuba_reduction(f, k)
-        poly_k_g = karatsuba_reduction(g, k)
+        poly_k_f = kronecker_reduction(f, k)
+        poly_k_g = kronecker_reduction(g, k)
         for i in range(n):
             F[i] -= poly_k_f[i] << (current_size - adjusted_size)
             G[i] -= poly_k_g[i] << (current_size - adjusted_size)
@@ -118,66 +148,161 @@ def ntru_solve(f, g):
         lifted_G = poly_lift(Gp)
         conjugated_g = conjugate_galois(g)
         conjugated_f = conjugate_galois(f)
-        F = karatsuba_reduction(lifted_F, conjugated_g)
-        G = karatsuba_reduction(lifted_G, conjugated_f)
+        F = kronecker_reduction(lifted_F, conjugated_g)
+        G = kronecker_reduction(lifted_G, conjugated_f)
         F, G = babai_reduction(f, g, F, G)
         return F, G
 
-def gs_norm(f, g, q):
-    norm_fg = square_norm([f, g])
-    product_fg = add(mul(f, adj(f)), mul(g, adj(g)))
-    Ft = div(adj(g), product_fg)
-    Gt = div(adj(f), product_fg)
-    norm_FG = (q ** 2) * square_norm([Ft, Gt])
-    return max(norm_fg, norm_FG)
-
-def gen_poly(n):
+def gen_poly(n, randombytes=urandom):
     sigma_fg = 1.43300980528773
     assert(n < 4096)
-    raw_samples = [samplerz(0, sigma_fg, sigma_fg - 0.001) for _ in range(4096)]
-    polynomial = [0] * n
+    raw_samples = samplerz_batch(np.zeros(4096), sigma_fg, sigma_fg - 0.001, randombytes)
     k = 4096 // n
-    for i in range(n):
-        polynomial[i] = sum(raw_samples[i * k + j] for j in range(k))
+    # The i-th coefficient is the sum of the samples i * k, ..., i * k + k - 1
+    polynomial = raw_samples.reshape(n, k).sum(axis=1).tolist()
     return polynomial
 
-def generate_ntru(n):
+# Squared norm bound of the Gram-Schmidt vectors of the NTRU basis
+GS_NORM_BOUND = (1.17 ** 2) * q
+
+# Number of candidates rejected at each stage of ntru_gen, and of keys output
+ntru_gen_stats = Counter()
+
+
+def gs_norm_fft(f_fft, g_fft, q):
+    """
+    Return the squared Gram-Schmidt norm of the NTRU basis of f and g, given in FFT
+    representation: the largest of the squared norms of (f, g) and of
+    q * (adj(g), adj(f)) / (f * adj(f) + g * adj(g)).
+    By Parseval, the squared norm of a polynomial is the squared norm of its FFT divided by n,
+    and |adj(g) / (f * adj(f) + g * adj(g))| ** 2 + |adj(f) / (f * adj(f) + g * adj(g))| ** 2
+    simplifies to 1 / (|f| ** 2 + |g| ** 2) at each point.
+    """
+    n = f_fft.shape[-1]
+    denominator = f_fft.real ** 2 + f_fft.imag ** 2 + g_fft.real ** 2 + g_fft.imag ** 2
+    norm_fg = denominator.sum() / n
+    norm_FG = (q ** 2) * (1 / denominator).sum() / n
+    return max(norm_fg, norm_FG)
+
+
+def ntru_gen_fft(n, randombytes=urandom, stats=ntru_gen_stats):
+    """
+    Same as ntru_gen, but also return the FFTs of f and g, which are computed
+    to check the candidates and can be reused by the caller.
+    The candidates go through the cheapest rejection tests first:
+    1. f must be invertible mod q (checked before g is even sampled)
+    2. the norm of (f, g) must be below the bound
+    3. the norm of (q * adj(g) / (f * adj(f) + g * adj(g)), ...) must be below the bound
+    4. the NTRU equation must be solvable
+    The number of candidates rejected at each stage is counted in stats.
+    """
     while True:
-        f = gen_poly(n)
-        g = gen_poly(n)
-        if gs_norm(f, g, q) > (1.17 ** 2) * q:
+        f = gen_poly(n, randombytes)
+        if any((elem == 0) for elem in ntt(f)):
+            stats["f not invertible"] += 1
             continue
-        f_ntt = ntt(f)
-        if any(elem == 0 for elem in f_ntt):
+        g = gen_poly(n, randombytes)
+        if square_norm([f, g]) > GS_NORM_BOUND:
+            stats["norm of (f, g) too large"] += 1
+            continue
+        f_fft = fft(f)
+        g_fft = fft(g)
+        if gs_norm_fft(f_fft, g_fft, q) > GS_NORM_BOUND:
+            stats["norm of (F, G) too large"] += 1
             continue
         try:
             F, G = ntru_solve(f, g)
-            F = [int(x) for x in F]
-            G = [int(x) for x in G]
-            return f, g, F, G
+        # If the NTRU equation cannot be solved, a ValueError is raised
+        # In this case, we start again
         except ValueError:
+            stats["NTRU equation not solvable"] += 1
             continue
+        F = [int(coef) for coef in F]
+        G = [int(coef) for coef in G]
+        stats["accepted"] += 1
+        return (f, g, F, G), (f_fft, g_fft)
 
-def ntru_gen(n):
+
+def generate_ntru(n, randombytes=urandom):
+    return ntru_gen(n, randombytes)
+
+
+def ntru_gen(n, randombytes=urandom, stats=ntru_gen_stats):
     """
     Implement the algorithm 5 (NTRUGen) of Falcon's documentation.
     At the end of the function, polynomials f, g, F, G in Z[x]/(x ** n + 1)
     are output, which verify f * G - g * F = q mod (x ** n + 1).
     """
-    while True:
-        f = gen_poly(n)
-        g = gen_poly(n)
-        if gs_norm(f, g, q) > (1.17 ** 2) * q:
-            continue
-        f_ntt = ntt(f)
-        if any((elem == 0) for elem in f_ntt):
-            continue
-        try:
-            F, G = ntru_solve(f, g)
-            F = [int(coef) for coef in F]
-            G = [int(coef) for coef in G]
-            return f, g, F, G
-        # If the NTRU equation cannot be solved, a ValueError is raised
-        # In this case, we start again
-        except ValueError:
-            continue
+    return ntru_gen_fft(n, randombytes, stats)[0]
+
+
+def ntru_gen_task(n, count, seed):
+    """
+    Generate count tuples (f, g, F, G) with ntru_gen, drawing the randomness from
+    a ChaCha20 PRG seeded with seed. This is one task of ntru_gen_many.
+    """
+    randombytes = RandomPool.from_seed(seed)
+    return [ntru_gen(n, randombytes) for _ in range(count)]
+
+
+def ntru_gen_many(n, count, workers=None):
+    """
+    Generate count tuples (f, g, F, G) in parallel, with a pool of workers processes.
+    The keys are generated by tasks of KEYS_PER_TASK keys, each task drawing its
+    randomness from its own freshly seeded PRG, and are yielded as soon as their
+    task finishes (so not in a deterministic order).
+    At most two tasks per worker are queued at any time, so that count can be very large.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_pending = 2 * workers
+        remaining = count
+        pending = set()
+        while remaining > 0 or pending:
+            while remaining > 0 and len(pending) < max_pending:
+                size = min(KEYS_PER_TASK, remaining)
+                pending.add(executor.submit(ntru_gen_task, n, size, urandom(SEED_BYTES)))
+                remaining -= size
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def write_keys(keys, n, file):
+    """
+    Write the tuples (f, g, F, G) of keys to file, one JSON object per line,
+    flushing after each key. Return the number of keys written.
+    """
+    written = 0
+    for f, g, F, G in keys:
+        file.write(json.dumps({"n": n, "f": f, "g": g, "F": F, "G": G}) + "\n")
+        file.flush()
+        written += 1
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate NTRU polynomials (f, g, F, G) in parallel.")
+    parser.add_argument("n", type=int, help="degree of the polynomials (a power of 2, at most 1024)")
+    parser.add_argument("count", type=int, help="number of keys to generate")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-o", "--output", default="-",
+                        help="key file, written as JSON lines (default: standard output)")
+    args = parser.parse_args(argv)
+    if args.n < 2 or args.n > 1024 or args.n & (args.n - 1):
+        parser.error("n must be a power of 2 between 2 and 1024")
+    keys = ntru_gen_many(args.n, args.count, args.workers)
+    if args.output == "-":
+        written = write_keys(keys, args.n, sys.stdout)
+    else:
+        # Append, so that an interrupted run can be completed by another one.
+        # The file holds secret keys: it is only readable by its owner.
+        fd = os.open(args.output, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "a") as file:
+            written = write_keys(keys, args.n, file)
+    print(f"{written} keys of degree {args.n} generated", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,33 +7,101 @@ The NTT implemented here is for polynomials in Z_q[x]/(phi), with:
 The code is voluntarily very similar to the code of the FFT.
 It is probably possible to use templating to merge both implementations.
 """
-from common import split, merge, q                     # Import split and merge
-from ntt_constants import roots_dict_Zq, inv_mod_q     # Import constants useful for the FFT
+import numpy as np
+from common import q
 
 
 """i2 is the inverse of 2 mod q."""
 i2 = 6145
 
 
+"""omega is a primitive 2048-th root of unity mod q: 11 generates the multiplicative group mod q,
+and 2048 divides q - 1 = 12288."""
+omega = pow(11, (q - 1) // 2048, q)
+
+
+def inv_mod_q(a):
+    """Return the inverse mod q of a (an integer or an array of integers), computed as a ** (q - 2).
+
+    0 is mapped to 0.
+    """
+    base = np.asarray(a, dtype=np.int64) % q
+    result = np.ones_like(base)
+    exponent = q - 2
+    while exponent:
+        if exponent & 1:
+            result = result * base % q
+        base = base * base % q
+        exponent >>= 1
+    return result
+
+
+def _root_exponents_zq(n):
+    """Return the exponents k such that the roots of phi_2n = x ** n + 1 mod q are the omega ** k.
+
+    The roots of x + 1 are [-1] = [omega ** 1024]. The roots for 2n are, for each root r for n,
+    its two square roots (s, -s), with s < q / 2 first.
+    """
+    if n == 1:
+        return [1024]
+    exponents = []
+    for k in _root_exponents_zq(n // 2):
+        # The square roots of omega ** k are omega ** (k / 2) and -omega ** (k / 2) = omega ** (k / 2 + 1024)
+        s = k // 2 if pow(omega, k // 2, q) < q // 2 else k // 2 + 1024
+        exponents += [s, (s + 1024) % 2048]
+    return exponents
+
+
+class RootsDictZq(dict):
+    """Dictionary of the roots of the cyclotomic polynomials mod q, in the order used by the NTT.
+
+    roots_dict_Zq[n] is the list of the n roots of phi_2n = x ** n + 1, for n a power of two,
+    2 <= n <= 1024. Each list is computed on first use, and is the same as the one of ntt_constants.
+    """
+
+    def __missing__(self, n):
+        if n < 2 or n > 1024 or n & (n - 1):
+            raise KeyError(n)
+        self[n] = [pow(omega, k, q) for k in _root_exponents_zq(n)]
+        return self[n]
+
+
+roots_dict_Zq = RootsDictZq()
+
+
 """ sqr1 is a square root of (-1) mod q (currently, sqr1 = 1479)."""
 sqr1 = roots_dict_Zq[2][0]
 
 
+"""Cache of the twiddle factors, indexed by the size of the merged polynomial."""
+_twiddles = {}
+
+
+def _roots_zq(n):
+    """Return the twiddle factors (w, w^(-1)) used to merge/split polynomials of size n.
+
+    w[i] is the root roots_dict_Zq[n][2 * i], the only ones used by merge_ntt and split_ntt.
+    """
+    if n not in _twiddles:
+        w = np.array(roots_dict_Zq[n][0::2], dtype=np.int64)
+        _twiddles[n] = (w, inv_mod_q(w))
+    return _twiddles[n]
+
+
 def split_ntt(f_ntt):
     """Split a polynomial f in two or three polynomials.
 
     Args:
-        f_ntt: a polynomial
+        f_ntt: a polynomial (or an array of polynomials, along the last axis)
 
     Format: NTT
     """
-    n = len(f_ntt)
-    w = roots_dict_Zq[n]
-    f0_ntt = [0] * (n // 2)
-    f1_ntt = [0] * (n // 2)
-    for i in range(n // 2):
-        f0_ntt[i] = (i2 * (f_ntt[2 * i] + f_ntt[2 * i + 1])) % q
-        f1_ntt[i] = (i2 * (f_ntt[2 * i] - f_ntt[2 * i + 1]) * inv_mod_q[w[2 * i]]) % q
+    f_ntt = np.asarray(f_ntt, dtype=np.int64)
+    n = f_ntt.shape[-1]
+    w_inv = _roots_zq(n)[1]
+    even, odd = f_ntt[..., 0::2], f_ntt[..., 1::2]
+    f0_ntt = (i2 * (even + odd)) % q
+    f1_ntt = (i2 * ((even - odd) * w_inv % q)) % q
     return [f0_ntt, f1_ntt]
 
 
@@ -41,78 +109,92 @@ def merge_ntt(f_list_ntt):
     """Merge two or three polynomials into a single polynomial f.
 
     Args:
-        f_list_ntt: a list of polynomials
+        f_list_ntt: a list of polynomials (or of arrays of polynomials)
 
     Format: NTT
     """
-    f0_ntt, f1_ntt = f_list_ntt
-    n = 2 * len(f0_ntt)
-    w = roots_dict_Zq[n]
-    f_ntt = [0] * n
-    for i in range(n // 2):
-        f_ntt[2 * i + 0] = (f0_ntt[i] + w[2 * i] * f1_ntt[i]) % q
-        f_ntt[2 * i + 1] = (f0_ntt[i] - w[2 * i] * f1_ntt[i]) % q
-    return f_ntt
+    f0_ntt = np.asarray(f_list_ntt[0], dtype=np.int64)
+    f1_ntt = np.asarray(f_list_ntt[1], dtype=np.int64)
+    n = 2 * f0_ntt.shape[-1]
+    w = _roots_zq(n)[0]
+    t = (w * f1_ntt) % q
+    f_ntt = np.empty(np.broadcast_shapes(f0_ntt.shape, t.shape)[:-1] + (n,), dtype=np.int64)
+    np.add(f0_ntt, t, out=f_ntt[..., 0::2])
+    np.subtract(f0_ntt, t, out=f_ntt[..., 1::2])
+    return f_ntt % q
 
 
 def ntt(f):
     """Compute the NTT of a polynomial.
 
     Args:
-        f: a polynomial
+        f: a polynomial (or an array of polynomials, along the last axis)
 
     Format: input as coefficients, output as NTT
+
+    This is the iterative version of the recursion f -> merge_ntt(ntt(f0), ntt(f1)),
+    with the same row layout as fft.fft: row j of the working array holds the NTT
+    of f[j::rows]. The reduction mod q is lazy: only the operand of the
+    multiplication by a root is reduced, the sums are reduced once at the end.
     """
-    n = len(f)
-    if (n > 2):
-        f0, f1 = split(f)
-        f0_ntt = ntt(f0)
-        f1_ntt = ntt(f1)
-        f_ntt = merge_ntt([f0_ntt, f1_ntt])
-    elif (n == 2):
-        f_ntt = [0] * n
-        f_ntt[0] = (f[0] + sqr1 * f[1]) % q
-        f_ntt[1] = (f[0] - sqr1 * f[1]) % q
-    return f_ntt
+    f = np.asarray(f, dtype=np.int64) % q
+    batch, n = f.shape[:-1], f.shape[-1]
+    a = f.reshape(batch + (n, 1))
+    rows, m = n, 1
+    while rows > 1:
+        rows //= 2
+        w = _roots_zq(2 * m)[0]
+        t = a[..., rows:, :] % q
+        t *= w
+        b = np.empty(batch + (rows, 2 * m), dtype=np.int64)
+        np.add(a[..., :rows, :], t, out=b[..., 0::2])
+        np.subtract(a[..., :rows, :], t, out=b[..., 1::2])
+        a, m = b, 2 * m
+    return a.reshape(batch + (n,)) % q
 
 
 def intt(f_ntt):
     """Compute the inverse NTT of a polynomial.
 
     Args:
-        f_ntt: a NTT of a polynomial
+        f_ntt: a NTT of a polynomial (or an array of them, along the last axis)
 
     Format: input as NTT, output as coefficients
+
+    This is the iterative version of the recursion f_ntt -> merge(intt(f0_ntt), intt(f1_ntt)).
+    The factors i2 of each level are not applied on the way: the result is
+    multiplied once by i2 ** log2(n) = 1 / n mod q.
     """
-    n = len(f_ntt)
-    if (n > 2):
-        f0_ntt, f1_ntt = split_ntt(f_ntt)
-        f0 = intt(f0_ntt)
-        f1 = intt(f1_ntt)
-        f = merge([f0, f1])
-    elif (n == 2):
-        f = [0] * n
-        f[0] = (i2 * (f_ntt[0] + f_ntt[1])) % q
-        f[1] = (i2 * inv_mod_q[1479] * (f_ntt[0] - f_ntt[1])) % q
-    return f
+    f_ntt = np.asarray(f_ntt, dtype=np.int64) % q
+    batch, n = f_ntt.shape[:-1], f_ntt.shape[-1]
+    a = f_ntt.reshape(batch + (1, n))
+    rows, m, scale = 1, n, 1
+    while m > 1:
+        w_inv = _roots_zq(m)[1]
+        even, odd = a[..., 0::2], a[..., 1::2]
+        b = np.empty(batch + (2 * rows, m // 2), dtype=np.int64)
+        np.add(even, odd, out=b[..., :rows, :])
+        np.subtract(even, odd, out=b[..., rows:, :])
+        b[..., rows:, :] *= w_inv
+        b[..., rows:, :] %= q
+        a, rows, m, scale = b, 2 * rows, m // 2, (scale * i2) % q
+    # Row j now holds the constant polynomial f[j]
+    return (a.reshape(batch + (n,)) % q) * scale % q
 
 
 def add_zq(f, g):
     """Addition of two polynomials (coefficient representation)."""
-    assert len(f) == len(g)
-    deg = len(f)
-    return [(f[i] + g[i]) % q for i in range(deg)]
+    return np.add(f, g, dtype=np.int64) % q
 
 
 def neg_zq(f):
     """Negation of a polynomials (any representation)."""
-    deg = len(f)
-    return [(- f[i]) % q for i in range(deg)]
+    return np.negative(f, dtype=np.int64) % q
 
 
 def sub_zq(f, g):
     """Substraction of two polynomials (any representation)."""
-    return add_zq(f, neg_zq(g))
+    return np.subtract(f, g, dtype=np.int64) % q
 
 
 def mul_zq(f, g):
@@ -145,18 +227,15 @@ def sub_ntt(f_ntt, g_ntt):
 
 def mul_ntt(f_ntt, g_ntt):
     """Multiplication of two polynomials (coefficient representation)."""
-    assert len(f_ntt) == len(g_ntt)
-    deg = len(f_ntt)
-    return [(f_ntt[i] * g_ntt[i]) % q for i in range(deg)]
+    return np.multiply(f_ntt, g_ntt, dtype=np.int64) % q
 
 
 def div_ntt(f_ntt, g_ntt):
     """Division of two polynomials (NTT representation)."""
-    assert len(f_ntt) == len(g_ntt)
-    deg = len(f_ntt)
-    if any(elt == 0 for elt in g_ntt):
+    g_ntt = np.asarray(g_ntt, dtype=np.int64) % q
+    if (g_ntt == 0).any():
         raise ZeroDivisionError
-    return [(f_ntt[i] * inv_mod_q[g_ntt[i]]) % q for i in range(deg)]
+    return np.multiply(f_ntt, inv_mod_q(g_ntt), dtype=np.int64) % q
 
 
 # def adj_ntt(f_ntt):
@@ -18,16 +18,47 @@ at a time (hence 512 * 8 = 4096 bits), and interleave the outputs by blocks
 of 32 bits. For reproducibility, we do the same here.
 """
 
+import os
+from os import urandom
+from threading import Lock, local
+from weakref import WeakSet
+import numpy as np
+
 # ChaCha20 constants
 CW = [0x61707865, 0x3320646e, 0x79622d32, 0x6b206574]
 
+# Size in bytes of the output of one call to the (8-way) block function
+BLOCK_BYTES = 16 * 4 * 8
+
+# Number of 8-way blocks generated at once when the buffer runs out
+BLOCKS_PER_REFILL = 16
+
 
 def roll(x, n):
     """
-    The roll function
-    Lifted from https://www.johndcook.com/blog/2019/03/03/do-the-chacha/
+    The roll function, on arrays of uint32.
+    Lifted from https://www.johndcook.com/blog/2019/03/03/do-the-chacha/,
+    then modified.
+    """
+    return (x << np.uint32(n)) | (x >> np.uint32(32 - n))
+
+
+def qround(x, A, B, C, D):
+    """
+    Quarter-round function, applied to all the lanes of the rows A, B, C, D of x.
+    Lifted from https://www.johndcook.com/blog/2019/03/03/do-the-chacha/,
+    then modified.
     """
-    return ((x << n) & 0xffffffff) + (x >> (32 - n))
+    a, b, c, d = x[A], x[B], x[C], x[D]
+    a += b
+    d = roll(d ^ a, 16)
+    c += d
+    b = roll(b ^ c, 12)
+    a += b
+    d = roll(d ^ a, 8)
+    c += d
+    b = roll(b ^ c, 7)
+    x[A], x[B], x[C], x[D] = a, b, c, d
 
 
 class ChaCha20:
@@ -35,11 +66,14 @@ class ChaCha20:
     def __init__(self, src):
         """
         Initialize the PRG. src is the initial seed, ctr is the counter,
-        and hexbytes is a buffer for the pseudorandom output.
+        and buffer holds the pseudorandom output not handed out yet.
         """
         self.s = [int.from_bytes(src[4 * i: 4 * (i + 1)], "little") for i in range(14)]
         self.ctr = self.s[12] + (self.s[13] << 32)
-        self.hexbytes = ""
+        # Rows 0 to 13 of the ChaCha20 state do not depend on the counter
+        self.state_head = np.array(CW + self.s[:10], dtype=np.uint32)
+        self.buffer = memoryview(b"")
+        self.position = 0
 
     def __repr__(self):
         """
@@ -52,70 +86,134 @@ class ChaCha20:
         rep += "ctr = " + str(self.ctr)
         return rep
 
-    def qround(self, A, B, C, D):
-        """
-        Quarter-round function.
-        Lifted from https://www.johndcook.com/blog/2019/03/03/do-the-chacha/,
-        then modified.
-        """
-        a = self.state[A]
-        b = self.state[B]
-        c = self.state[C]
-        d = self.state[D]
-        a = (a + b) & 0xffffffff
-        d = roll(d ^ a, 16)
-        c = (c + d) & 0xffffffff
-        b = roll(b ^ c, 12)
-        a = (a + b) & 0xffffffff
-        d = roll(d ^ a, 8)
-        c = (c + d) & 0xffffffff
-        b = roll(b ^ c, 7)
-        self.state[A] = a
-        self.state[B] = b
-        self.state[C] = c
-        self.state[D] = d
-
-    def update(self):
-        """
-        One update of the ChaCha20 PRG.
-        """
-        self.state = [0] * 16
-        self.state[0:4] = CW[:]
-        self.state[4:14] = [self.s[i] for i in range(10)]
-        self.state[14] = self.s[10] ^ (self.ctr & 0xffffffff)
-        self.state[15] = self.s[11] ^ (self.ctr >> 32)
-        state = self.state[:]
+    def block_update(self, blocks=1):
+        """
+        Produces 8 * blocks consecutive updates. The 8 updates of each block
+        are interleaved by words of 32 bits, as in the reference code.
+        All the updates are computed at once, one lane per update.
+        """
+        lanes = 8 * blocks
+        ctr = (self.ctr + np.arange(lanes, dtype=np.uint64)) & np.uint64(0xffffffffffffffff)
+        state = np.empty((16, lanes), dtype=np.uint32)
+        state[:14] = self.state_head[:, None]
+        state[14] = np.uint32(self.s[10]) ^ (ctr & np.uint64(0xffffffff)).astype(np.uint32)
+        state[15] = np.uint32(self.s[11]) ^ (ctr >> np.uint64(32)).astype(np.uint32)
+        x = [row.copy() for row in state]
         for _ in range(10):
-            self.qround(0, 4, 8, 12)
-            self.qround(1, 5, 9, 13)
-            self.qround(2, 6, 10, 14)
-            self.qround(3, 7, 11, 15)
-            self.qround(0, 5, 10, 15)
-            self.qround(1, 6, 11, 12)
-            self.qround(2, 7, 8, 13)
-            self.qround(3, 4, 9, 14)
-        for i in range(16):
-            self.state[i] = (self.state[i] + state[i]) & 0xffffffff
-        self.ctr += 1
-        return self.state
-
-    def block_update(self):
-        """
-        Produces 8 consecurite updates, and interleave the results.
-        """
-        block = [None] * 16 * 8
-        for i in range(8):
-            block[i::8] = self.update()
-        return "".join(elt.to_bytes(4, "little").hex() for elt in block)
+            qround(x, 0, 4, 8, 12)
+            qround(x, 1, 5, 9, 13)
+            qround(x, 2, 6, 10, 14)
+            qround(x, 3, 7, 11, 15)
+            qround(x, 0, 5, 10, 15)
+            qround(x, 1, 6, 11, 12)
+            qround(x, 2, 7, 8, 13)
+            qround(x, 3, 4, 9, 14)
+        out = np.array(x) + state
+        self.ctr += lanes
+        # Word j of update i of a block lands at index 8 * j + i of that block
+        out = out.reshape(16, blocks, 8).transpose(1, 0, 2)
+        return out.astype("<u4").tobytes()
 
     def randombytes(self, k):
         """
         Generate random bytes.
-        Perform some shenanigans to match the reference code PRG.
-        """
-        if (2 * k > len(self.hexbytes)):
-            self.hexbytes = self.block_update()
-        out = self.hexbytes[:(2 * k)]
-        out = "".join(out[i:i + 2] for i in range(2 * k - 2, -1, -2))
-        self.hexbytes = self.hexbytes[(2 * k):]
-        return bytes.fromhex(out)[::-1]
+        As in the reference code, a request that does not fit in what remains
+        of the current block is served from the start of the next block.
+        """
+        remaining = (-self.position) % BLOCK_BYTES
+        if k > remaining:
+            self.position += remaining
+        if self.position + k > len(self.buffer):
+            blocks = max(BLOCKS_PER_REFILL, -(-k // BLOCK_BYTES))
+            self.buffer = memoryview(bytes(self.buffer[self.position:]) + self.block_update(blocks))
+            self.position = 0
+        out = bytes(self.buffer[self.position:self.position + k])
+        self.position += k
+        return out
+
+
+class PoolBuffer(local):
+    """
+    Buffer of a RandomPool for one thread: the random bytes, and the position
+    of the first one not handed out yet.
+    """
+    buffer = memoryview(b"")
+    position = 0
+
+
+class RandomPool:
+    """
+    Buffered source of random bytes.
+
+    The pool reads large blocks from its source (os.urandom by default, or a
+    ChaCha20 PRG when seeded) and hands out slices of them as memoryviews.
+    An instance can be used wherever a random_bytes function is expected.
+    Each thread has its own buffer, so that handing out bytes takes no lock:
+    only the refills, which call the source, are serialized.
+    """
+
+    def __init__(self, source=urandom, buffer_size=1 << 16):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.local = PoolBuffer()
+        # Statistics
+        self.bytes_drawn = 0
+        self.refills = 0
+        self.lock = Lock()
+        if source is urandom:
+            urandom_pools.add(self)
+
+    @classmethod
+    def from_seed(cls, seed, buffer_size=1 << 16):
+        """
+        Create a pool drawing from a ChaCha20 PRG seeded with seed.
+        """
+        return cls(ChaCha20(seed).randombytes, buffer_size)
+
+    def __repr__(self):
+        return f"RandomPool: {self.bytes_drawn} bytes drawn from the source, {self.refills} refills"
+
+    def reset(self):
+        """
+        Drop the bytes buffered by all the threads.
+        """
+        self.local = PoolBuffer()
+
+    def refill(self, k):
+        """
+        Refill the buffer of the current thread with at least k bytes, keeping the unused ones.
+        """
+        state = self.local
+        size = max(self.buffer_size, k)
+        with self.lock:
+            fresh = self.source(size)
+            self.bytes_drawn += size
+            self.refills += 1
+        state.buffer = memoryview(bytes(state.buffer[state.position:]) + fresh)
+        state.position = 0
+
+    def __call__(self, k):
+        """
+        Return the next k random bytes, as a memoryview.
+        """
+        state = self.local
+        position = state.position
+        if position + k > len(state.buffer):
+            self.refill(k)
+            position = 0
+        state.position = position + k
+        return state.buffer[position:position + k]
+
+
+# Pools drawing from os.urandom: a forked child must not reuse the bytes already
+# handed out to its parent, so it drops their buffers
+urandom_pools = WeakSet()
+
+
+def reset_urandom_pools():
+    for pool in list(urandom_pools):
+        pool.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_urandom_pools)
@@ -3,6 +3,7 @@ Sampler for generating discrete Gaussian random variables as required for Falcon
 """
 from math import floor
 from os import urandom
+import numpy as np
 
 # Upper limit for sigma values
 MAX_SIGMA = 1.8205
@@ -33,8 +34,11 @@ POLY_COEFFS = [
     0x8000000000000000
 ]
 
-def base_sampler(random_bytes=urandom):
-    u = int.from_bytes(random_bytes(PREC_RCDT >> 3), "little")
+# Bytes consumed by one trial of samplerz: base sampler, sign bit, Bernoulli trial
+TRIAL_BYTES = (PREC_RCDT >> 3) + 1 + 8
+
+def base_sampler(u):
+    """Sample the half-Gaussian from u, a random integer of PREC_RCDT bits."""
     z0 = 0
     for threshold in REVERSE_CDT:
         z0 += int(u < threshold)
@@ -48,17 +52,16 @@ def approx_exp(x, scaling_factor):
     y = (z * y) >> 63
     return y
 
-def bernoulli_exp(x, scaling_factor, random_bytes=urandom):
+def bernoulli_exp(x, scaling_factor, p):
+    """Bernoulli trial of parameter scaling_factor * exp(-x), with p a random 64-bit integer."""
     shift = int(x * INVERSE_LN2)
     remainder = x - shift * LN2
     shift = min(shift, 63)
     z = (approx_exp(remainder, scaling_factor) - 1) >> shift
-    for i in range(56, -8, -8):
-        p = int.from_bytes(random_bytes(1), "little")
-        w = p - ((z >> i) & 0xFF)
-        if w != 0:
-            break
-    return w < 0
+    # Comparing 8 random bytes one at a time to the low 64 bits of z, from the most
+    # significant one, and stopping at the first difference, is the same as comparing
+    # them as a big-endian integer
+    return p < (z & 0xFFFFFFFFFFFFFFFF)
 
 def samplerz(mu, sigma, sigma_min, random_bytes=urandom):
     integer_part = int(floor(mu))
@@ -66,10 +69,120 @@ def samplerz(mu, sigma, sigma_min, random_bytes=urandom):
     variance_scale = 1 / (2 * sigma * sigma)
     scaling_factor = sigma_min / sigma
     while True:
-        z0 = base_sampler(random_bytes)
-        sign_bit = int.from_bytes(random_bytes(1), "little") & 1
+        # The randomness of a trial is read at once
+        trial = random_bytes(TRIAL_BYTES)
+        z0 = base_sampler(int.from_bytes(trial[:PREC_RCDT >> 3], "little"))
+        sign_bit = trial[PREC_RCDT >> 3] & 1
         z = sign_bit + (2 * sign_bit - 1) * z0
         x = ((z - fractional_part) ** 2) * variance_scale
         x -= (z0 ** 2) * INVERSE_2SIGMA2
-        if bernoulli_exp(x, scaling_factor, random_bytes):
+        if bernoulli_exp(x, scaling_factor, int.from_bytes(trial[-8:], "big")):
             return z + integer_part
+
+
+# Tables for the vectorized sampler: the 72-bit thresholds are split into their
+# high 8 bits and low 64 bits, the 64-bit constants are stored as uint64
+REVERSE_CDT_HIGH = np.array([threshold >> 64 for threshold in REVERSE_CDT], dtype=np.uint64)
+REVERSE_CDT_LOW = np.array([threshold & ((1 << 64) - 1) for threshold in REVERSE_CDT], dtype=np.uint64)
+POLY_COEFFS_U64 = np.array(POLY_COEFFS, dtype=np.uint64)
+MASK32 = np.uint64(0xFFFFFFFF)
+ONE, SHIFT31, SHIFT32 = np.uint64(1), np.uint64(31), np.uint64(32)
+
+# Number of trials run at once by samplerz_batch, per entry and per round
+MIN_TRIALS_PER_ENTRY = 2
+MIN_TRIALS_PER_ROUND = 64
+
+
+def mul_shift63(a_low, a_high, b):
+    """Compute (a * b) >> 63 for arrays of uint64, without overflowing.
+
+    a is given by its 32-bit halves a_low and a_high, so that it can be reused.
+    The 128-bit product is computed from four 32 x 32-bit products.
+    """
+    b_low, b_high = b & MASK32, b >> SHIFT32
+    p00, p01, p10 = a_low * b_low, a_low * b_high, a_high * b_low
+    mid = (p00 >> SHIFT32) + (p01 & MASK32) + (p10 & MASK32)
+    high = a_high * b_high
+    high += p01 >> SHIFT32
+    high += p10 >> SHIFT32
+    high += mid >> SHIFT32
+    # Bit 63 of the product is bit 31 of mid
+    return (high << ONE) | ((mid >> SHIFT31) & ONE)
+
+
+def base_sampler_batch(u_high, u_low):
+    """Vectorized base_sampler, for 72-bit values split into their high 8 bits and low 64 bits."""
+    u_high = u_high[:, None]
+    u_low = u_low[:, None]
+    below = (u_high < REVERSE_CDT_HIGH) | ((u_high == REVERSE_CDT_HIGH) & (u_low < REVERSE_CDT_LOW))
+    return below.sum(axis=1, dtype=np.int64)
+
+
+def approx_exp_batch(x, scaling_factor):
+    """Vectorized approx_exp, for arrays of x and scaling_factor."""
+    z = (x * (1 << 63)).astype(np.uint64)
+    z_low, z_high = z & MASK32, z >> SHIFT32
+    y = np.full(x.shape, POLY_COEFFS_U64[0], dtype=np.uint64)
+    for coeff in POLY_COEFFS_U64[1:]:
+        y = coeff - mul_shift63(z_low, z_high, y)
+    z = (scaling_factor * (1 << 63)).astype(np.uint64) << ONE
+    return mul_shift63(z & MASK32, z >> SHIFT32, y)
+
+
+def bernoulli_exp_batch(x, scaling_factor, p):
+    """Vectorized bernoulli_exp, with p the 8 random bytes of each trial read as a big-endian integer."""
+    shift = (x * INVERSE_LN2).astype(np.int64)
+    remainder = x - shift * LN2
+    shift = np.minimum(shift, 63).astype(np.uint64)
+    exp = np.zeros(x.shape, dtype=np.uint64)
+    # remainder can be very slightly negative when x is close to a multiple of LN2:
+    # these rare trials go through the scalar approx_exp, which handles it
+    positive = remainder >= 0
+    exp[positive] = approx_exp_batch(remainder[positive], scaling_factor[positive])
+    for i in np.flatnonzero(~positive):
+        exp[i] = approx_exp(remainder[i], scaling_factor[i])
+    z = (exp - ONE) >> shift
+    return p < z
+
+
+def samplerz_batch(mu, sigma, sigma_min, random_bytes=urandom):
+    """
+    Vectorized samplerz: sample one integer for each entry of mu.
+    sigma can be an array of the same shape as mu or a scalar.
+    The randomness of all the trials is drawn in one call to random_bytes,
+    and only the rejected entries are sampled again.
+    """
+    mu = np.asarray(mu, dtype=np.float64)
+    shape = mu.shape
+    mu = mu.ravel()
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=np.float64), shape).ravel()
+    integer_part = np.floor(mu)
+    fractional_part = mu - integer_part
+    variance_scale = 1 / (2 * sigma * sigma)
+    scaling_factor = sigma_min / sigma
+    result = np.zeros(mu.shape, dtype=np.int64)
+    pending = np.arange(mu.size)
+    while pending.size > 0:
+        count = pending.size
+        # Each pending entry gets several independent trials, and keeps the first accepted one:
+        # this has the same distribution as retrying, with fewer rounds
+        trials = max(MIN_TRIALS_PER_ENTRY, -(-MIN_TRIALS_PER_ROUND // count))
+        lanes = np.repeat(pending, trials)
+        raw = np.frombuffer(random_bytes(TRIAL_BYTES * lanes.size), dtype=np.uint8).reshape(lanes.size, TRIAL_BYTES)
+        u_low = raw[:, 0:8].copy().view("<u8").ravel()
+        u_high = raw[:, 8].astype(np.uint64)
+        sign_bit = (raw[:, 9] & 1).astype(np.int64)
+        p = raw[:, 10:18].copy().view(">u8").ravel()
+
+        z0 = base_sampler_batch(u_high, u_low)
+        z = sign_bit + (2 * sign_bit - 1) * z0
+        x = ((z - fractional_part[lanes]) ** 2) * variance_scale[lanes]
+        x -= (z0 ** 2) * INVERSE_2SIGMA2
+        accepted = bernoulli_exp_batch(x, scaling_factor[lanes], p).reshape(count, trials)
+
+        hit = accepted.any(axis=1)
+        first = np.arange(count) * trials + accepted.argmax(axis=1)
+        done = pending[hit]
+        result[done] = z[first[hit]] + integer_part[done].astype(np.int64)
+        pending = pending[~hit]
+    return result.reshape(shape)
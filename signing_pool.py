@@ -0,0 +1,155 @@
+"""
+Process pool running the CPU-bound Falcon operations of the service
+(key generation, signing, verification) outside of the event loop.
+Secret keys are saved once to files (see SecretKey.save): a request only sends
+the path of its key, and each worker loads the key on first use and keeps it
+in memory. A key file must therefore never be modified once written.
+Binary requests (see wire) are decoded in the workers, straight from the received body.
+The number of requests waiting for or running in the pool is bounded:
+beyond max_pending, run raises PoolOverloaded instead of queueing.
+"""
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from falcon import PublicKey, SecretKey
+from wire import decode_fields
+
+# Number of secret keys (and of public keys) kept in memory by each worker
+KEY_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def load_secret_key(path):
+    """Load the secret key saved at path, once per worker."""
+    return SecretKey.load(path)
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def load_public_key(data):
+    """Load a serialized public key, once per worker."""
+    return PublicKey.from_bytes(data)
+
+
+def generate_key(n, path):
+    """
+    Generate a secret key of degree n, save it to path, and return the serialized public key.
+    Raise FileExistsError if path already exists: a key file is never replaced.
+    """
+    sk = SecretKey(n)
+    sk.save(path, exclusive=True)
+    return PublicKey(sk).to_bytes()
+
+
+def sign(path, message):
+    """Sign message with the secret key saved at path."""
+    return load_secret_key(path).sign(message)
+
+
+def verify(public_key, message, signature):
+    """Verify signature of message against a serialized public key."""
+    return load_public_key(public_key).verify(message, signature)
+
+
+def sign_many(path, messages):
+    """Sign a batch of messages with the secret key saved at path."""
+    return load_secret_key(path).sign_many(messages)
+
+
+def verify_many(public_key, messages, signatures):
+    """
+    Verify a batch of (message, signature) pairs against a serialized public key.
+    Return, for each pair, whether it is valid and the reason why it is not (see PublicKey.verify_many).
+    """
+    valid, reasons = load_public_key(public_key).verify_many(messages, signatures)
+    return valid.tolist(), reasons
+
+
+def sign_hashed(path, hashed, salt):
+    """Sign the point hashed from salt and a message (see falcon.PointHasher) with the secret key saved at path."""
+    return load_secret_key(path).sign_hashed(hashed, salt)
+
+
+def verify_hashed(public_key, hashed, signature):
+    """Verify signature against the point hashed from its salt and a message, and a serialized public key."""
+    return load_public_key(public_key).verify_hashed(hashed, signature)
+
+
+def sign_encoded(path, body, media_type):
+    """Sign the message of a binary request body (see wire.decode_fields) with the secret key saved at path."""
+    message, = decode_fields(body, media_type, ("message",))
+    return load_secret_key(path).sign(message)
+
+
+def verify_encoded(public_key, body, media_type):
+    """Verify the message and signature of a binary request body against a serialized public key."""
+    message, signature = decode_fields(body, media_type, ("message", "signature"))
+    return load_public_key(public_key).verify(message, signature)
+
+
+class PoolOverloaded(Exception):
+    """Raised when too many requests are already waiting for the pool."""
+
+
+class SigningPool:
+
+    def __init__(self, workers=None, max_pending=None):
+        """
+        Start a pool of workers processes (one per CPU by default), accepting at most
+        max_pending requests at a time (8 per worker by default).
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.max_pending = max_pending if max_pending is not None else 8 * self.workers
+        self.pending = 0
+
+    def __repr__(self):
+        return f"SigningPool({self.workers} workers, {self.pending}/{self.max_pending} pending)"
+
+    async def run(self, function, *args):
+        """
+        Run function(*args) in the pool and return its result.
+        Raise PoolOverloaded if max_pending requests are already pending.
+        """
+        if self.pending >= self.max_pending:
+            raise PoolOverloaded(f"{self.pending} requests pending")
+        # pending is only updated from the event loop, so it needs no lock
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    def check(self, slots=1):
+        """Raise PoolOverloaded if slots more requests would exceed max_pending."""
+        if self.pending + slots > self.max_pending:
+            raise PoolOverloaded(f"{self.pending} requests pending")
+
+    async def map(self, function, args_list, window=None):
+        """
+        Run function(*args) for each args of args_list, and yield the results in order.
+        At most window calls (one per worker by default) are pending at a time, and they
+        count as window requests for max_pending during the whole iteration.
+        The capacity is not checked here, as the results may already be streamed:
+        call check(window) before.
+        """
+        args_list = list(args_list)
+        window = min(window or self.workers, len(args_list))
+        loop = asyncio.get_running_loop()
+        futures = deque()
+        self.pending += window
+        try:
+            for args in args_list:
+                futures.append(loop.run_in_executor(self.executor, function, *args))
+                if len(futures) == window:
+                    yield await futures.popleft()
+            while futures:
+                yield await futures.popleft()
+        finally:
+            self.pending -= window
+            for future in futures:
+                future.cancel()
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,382 @@
+"""
+Known-answer tests of the primitives rewritten for speed.
+The expected values were computed with the original implementations: the
+rewritten ones must keep producing exactly the same output.
+The inputs are derived from SHAKE256, and the long outputs are compared
+through their SHA-256 digest.
+
+Run with: python -m unittest test_known_answers
+"""
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+import numpy as np
+from encoding import compress, decompress, pack_bits
+from ffsampling import ffsampling_fft, ffsampling_fft_inplace, SamplingWorkspace
+from fft import fft, ifft
+from falcon import SecretKey, PublicKey, hash_to_point, hash_to_point_many
+from ntt import ntt, intt, mul_zq
+from common import q
+from rng import ChaCha20, RandomPool
+from samplerz import samplerz_batch, approx_exp, approx_exp_batch, bernoulli_exp, bernoulli_exp_batch
+
+
+def shake(label, length):
+    """Deterministic test input: length bytes of SHAKE256 of label."""
+    return hashlib.shake_256(label.encode()).digest(length)
+
+
+def digest(values):
+    """SHA-256 of the concatenated repr of values."""
+    sha256 = hashlib.sha256()
+    for value in values:
+        sha256.update(repr(value).encode())
+    return sha256.hexdigest()
+
+
+class TestChaCha20(unittest.TestCase):
+
+    # Requests of mixed sizes, some of which do not fit in the current block
+    SIZES = [1, 7, 32, 100, 512, 3, 256, 255, 2, 511, 64, 40, 56, 1, 500] * 4
+
+    def check_stream(self, seed, head, sha256):
+        prg = ChaCha20(seed)
+        out = b"".join(prg.randombytes(k) for k in self.SIZES)
+        self.assertEqual(len(out), sum(self.SIZES))
+        self.assertEqual(out[:32].hex(), head)
+        self.assertEqual(hashlib.sha256(out).hexdigest(), sha256)
+
+    def test_stream(self):
+        self.check_stream(bytes(range(56)),
+                          "cf9d141a20bdfdbd9e9fb9ba369a57b29f89044f0f540a2405230625ebdc8d4d",
+                          "0d71b33483c71ede6d565c6572154450e53422b6cd035132162e8abe5b36a995")
+
+    def test_counter_carry(self):
+        # The low word of the counter overflows into the high word during the stream
+        seed = bytes(range(48)) + (0xfffffff8).to_bytes(4, "little") + bytes(4)
+        self.check_stream(seed,
+                          "14f23cb5901b635e05b7262952b60352b498ff1122e6af695edeffbe4c11b5be",
+                          "8805406e70151a47fcddec419be1b514988d62270a236cac56746f6a18f2a2c3")
+
+
+class TestCompression(unittest.TestCase):
+
+    # Byte length of the compressed part of a signature, for each n
+    SLEN = {8: 11, 64: 81, 512: 625}
+
+    def compress_inputs(self):
+        """Vectors of n coefficients uniform in [-bound, bound]: the largest do not fit."""
+        for i, (n, bound) in enumerate([(8, 200), (64, 400), (512, 300), (512, 700)] * 10):
+            v = np.frombuffer(shake(f"compress {i}", 2 * n), dtype="<u2") % (2 * bound + 1)
+            yield n, [int(x) - bound for x in v]
+
+    def test_compress(self):
+        self.assertEqual(compress([0, 1, -1, 127, -128, 300], 11).hex(), "0080e06ff804b080000000")
+        encodings = [compress(v, self.SLEN[n]) for n, v in self.compress_inputs()]
+        self.assertEqual(sum(x is False for x in encodings), 14)
+        self.assertEqual(digest(encodings), "bde6f8ccf6772fec3f7a36ec1d04893046729654a5a7391048d2f88585db110c")
+
+    def test_round_trip(self):
+        for n, v in self.compress_inputs():
+            x = compress(v, self.SLEN[n])
+            if x is not False:
+                self.assertEqual(decompress(x, self.SLEN[n], n), v)
+
+    def test_decompress_fuzz(self):
+        # Random byte strings, most of which are not valid encodings
+        # (the original implementation raised ValueError on some of them, counted as False)
+        results = []
+        with redirect_stdout(io.StringIO()):
+            for i in range(2000):
+                n = (8, 64)[i % 2]
+                x = shake(f"decompress {i}", 1 + i % (self.SLEN[n] + 2))
+                results.append(decompress(x, self.SLEN[n], n))
+        self.assertEqual(sum(v is not False for v in results), 140)
+        self.assertEqual(digest(results), "efd4785abdbd46813dbe83b33e73bc1f7290e17532db1684af31897cc0b71d04")
+
+    def test_rejected_encodings(self):
+        x = compress([5, -3], 4)
+        self.assertEqual(x.hex(), "05c1c000")
+        self.assertEqual(decompress(x, 4, 2), [5, -3])
+        with redirect_stdout(io.StringIO()):
+            # Longer than slen
+            self.assertIs(decompress(x + b"\x00", 4, 2), False)
+        # Too few coefficients
+        self.assertIs(decompress(x, 4, 3), False)
+        # No bit set
+        self.assertIs(decompress(bytes(4), 4, 1), False)
+        # -0, which would give a second encoding of 0
+        self.assertIs(decompress(bytes([0x80, 0x80]), 2, 1), False)
+        # Truncated coefficient
+        self.assertIs(decompress(bytes([0x05]), 1, 1), False)
+        # Coefficients too large for slen
+        self.assertIs(compress([5000], 3), False)
+
+
+class TestNTT(unittest.TestCase):
+
+    def polys(self, label):
+        """Polynomials of every degree, with coefficients in [0, q)."""
+        for i, n in enumerate([2, 4, 8, 16, 32, 64, 128, 256, 512, 1024] * 3):
+            yield [int(x) % q for x in np.frombuffer(shake(f"{label} {i}", 2 * n), dtype="<u2")]
+
+    def test_ntt(self):
+        self.assertEqual([int(x) for x in ntt([1, 2, 3, 4])], [4229, 4647, 1973, 1444])
+        results = [[int(x) for x in ntt(f)] for f in self.polys("ntt")]
+        self.assertEqual(digest(results), "4fe8b8387609cbf0f25ca34f74fb5032d574b52430b6d8e318d92a91e8a4a6c8")
+
+    def test_intt(self):
+        results = [[int(x) for x in intt(f)] for f in self.polys("ntt")]
+        self.assertEqual(digest(results), "fc754a79223f81286ab99ff13c2981a787bc3b12f2094de2b1db2922297868ff")
+        for f in self.polys("ntt"):
+            self.assertEqual([int(x) for x in intt(ntt(f))], f)
+
+    def test_mul_zq(self):
+        self.assertEqual([int(x) for x in mul_zq([1, 2, 3, 4], [5, 6, 7, 8])], [12233, 12253, 2, 60])
+        results = [[int(x) for x in mul_zq(f, g)] for f, g in zip(self.polys("ntt"), self.polys("mul"))]
+        self.assertEqual(digest(results), "0d6c457d07ac6ec5dcb28b410c564f4b4ed33ce63950d3a11194c707f1b64f97")
+
+
+class TestSamplerZ(unittest.TestCase):
+
+    def uniform(self, label, size, high):
+        """size floats uniform in [0, high)."""
+        return np.frombuffer(shake(label, 8 * size), dtype="<u8") / 2.0 ** 64 * high
+
+    def test_approx_exp_batch(self):
+        x, scaling_factor = self.uniform("x", 1000, 0.7), 0.7 + self.uniform("scaling", 1000, 0.3)
+        self.assertEqual(approx_exp_batch(x, scaling_factor).tolist(),
+                         [approx_exp(a, b) for a, b in zip(x, scaling_factor)])
+
+    def test_bernoulli_exp_batch(self):
+        x, scaling_factor = self.uniform("x", 1000, 3), 0.7 + self.uniform("scaling", 1000, 0.3)
+        p = np.frombuffer(shake("p", 8 * 1000), dtype=">u8")
+        self.assertEqual(bernoulli_exp_batch(x, scaling_factor, p).tolist(),
+                         [bernoulli_exp(a, b, int(c)) for a, b, c in zip(x, scaling_factor, p)])
+
+    def test_samplerz_batch(self):
+        mu = np.linspace(-3, 3, 20000) + 0.3
+        z = samplerz_batch(mu, 1.5, 1.278, RandomPool(ChaCha20(bytes(56)).randombytes))
+        self.assertEqual(z.dtype, np.int64)
+        self.assertEqual(z[:10].tolist(), [-2, -4, -3, -1, -2, -4, -1, -4, -3, -3])
+        self.assertEqual(hashlib.sha256(z.tobytes()).hexdigest(),
+                         "45bebba2b5a5d7b4ff58d3a8b2aedbbdde616bfd28afaa9ab3fba51b552d064c")
+        # The errors z - mu have mean 0 and variance sigma ** 2, up to about 5 standard errors
+        self.assertAlmostEqual((z - mu).mean(), 0, delta=0.06)
+        self.assertAlmostEqual((z - mu).var(), 1.5 ** 2, delta=0.12)
+
+    def test_samplerz_batch_sigmas(self):
+        # One sigma per entry, in the range of the leaves of the tree
+        sigma = np.where(np.arange(20000) % 2, 1.3, 1.8)
+        z = samplerz_batch(np.zeros((100, 200)), sigma.reshape(100, 200), 1.278,
+                           RandomPool(ChaCha20(bytes(56)).randombytes)).ravel()
+        self.assertAlmostEqual(z[1::2].var(), 1.3 ** 2, delta=0.12)
+        self.assertAlmostEqual(z[::2].var(), 1.8 ** 2, delta=0.23)
+
+
+class TestHashToPoint(unittest.TestCase):
+
+    def inputs(self):
+        for i in range(100):
+            yield shake(f"message {i}", 37 * i), shake(f"salt {i}", 40), (2, 8, 64, 512, 1024)[i % 5]
+
+    def test_hash_to_point(self):
+        self.assertEqual(hash_to_point(b"Hello!", bytes(40), 512)[:8].tolist(),
+                         [1925, 10056, 8012, 8320, 2515, 4959, 6397, 1850])
+        points = [hash_to_point(message, salt, n).tolist() for message, salt, n in self.inputs()]
+        self.assertEqual(digest(points), "fc50f4959f2f40c01998747ef954a1e77fc352cb6946271cc028446df3f0b9fc")
+
+    def test_hash_to_point_many(self):
+        inputs = [(message, salt) for message, salt, n in self.inputs() if n == 512]
+        points = hash_to_point_many([message for message, _ in inputs], [salt for _, salt in inputs], 512)
+        self.assertEqual(points.shape, (len(inputs), 512))
+        for (message, salt), point in zip(inputs, points):
+            self.assertEqual(point.tolist(), hash_to_point(message, salt, 512).tolist())
+
+
+class TestSeededSignature(unittest.TestCase):
+
+    # A secret key (f, g, F, G) of degree 64
+    POLYS = [
+        [8, 5, 14, 12, -10, -1, -15, -6, -5, -26, 2, -7, -8, -7, 13, 15, 6, -11, -15, 0, -8, -15,
+         1, -17, 19, -5, 14, 7, 8, -6, -1, -8, -11, -14, 4, -4, 2, 6, -11, 11, 0, -18, 5, 6, 1, 16,
+         2, -6, -20, -7, -11, -11, -3, 4, -2, -3, -12, -10, 8, 9, -2, 19, 6, 8],
+        [11, 3, -16, 13, -16, 12, 19, 6, -15, -4, 18, -13, -3, -3, 3, -18, -13, 23, -11, -1, 11,
+         -16, -15, -1, -14, 10, 8, -1, -8, -17, -7, 14, 8, -14, 1, 1, -10, -27, 2, -18, -9, -6,
+         -13, -7, -10, -9, 16, 2, 5, 2, 11, 18, 12, -4, 6, 15, 6, 8, 8, 2, 1, 5, 0, -10],
+        [-43, -16, 25, -49, 13, -3, -21, 19, 20, -8, -35, -37, 7, -32, 4, -29, 6, 9, 28, -26, 30,
+         -27, 1, 24, -19, -23, 32, -58, 20, 6, -3, -15, -9, -26, -39, -10, 49, -14, 47, 40, 2, 70,
+         -33, -33, 7, -35, -25, -29, -11, -21, -2, 23, 7, -7, 30, -16, -30, -24, 39, 22, -8, -9,
+         -8, -26],
+        [11, -26, -12, 47, 18, -23, -45, -9, 49, 48, -42, 44, -16, -32, 52, 45, -22, -48, -1, -1,
+         -70, 13, 13, -28, 28, 7, 24, -37, 18, 61, -6, 10, 17, -10, -28, 25, -32, -49, -74, 0, -41,
+         -15, -16, -9, 19, -20, 13, 44, 33, -13, 41, 33, 29, 36, -11, 61, 57, 0, -6, 8, 41, -40,
+         10, 7],
+    ]
+
+    # The signatures were recorded from the current implementation: the bytes drawn
+    # by each trial of samplerz differ from the original one
+    SIGNATURE = (
+        "3665c7df7043958a926270dca4bf17f29c8ecb6e2a5dd08ecb331df85a5b4d501daf21778c0675a1ee7a9a"
+        "ecfe0adfdbe6df59e574dfc4b6c6d24e94926be897ca9a3c898435b7473db72f3172a1d6e86048a948f4df"
+        "362f8ce556cfc0260a25633b898329d4deca382d7936349e129501e4c2dd512400000000")
+
+    def setUp(self):
+        self.sk = SecretKey(64, self.POLYS)
+        self.pk = PublicKey(self.sk)
+
+    def test_public_key(self):
+        self.assertEqual(hashlib.sha256(self.pk.to_bytes()).hexdigest(),
+                         "c5f05b15172a5fb4f11fbf0d2a45f067273579c72a2eeff09751eafb8f083a8d")
+
+    def test_sign(self):
+        signature = self.sk.sign(b"Hello!", seed=shake("seed", 56), salt=shake("salt", 40))
+        self.assertEqual(signature.hex(), self.SIGNATURE)
+        self.assertTrue(self.pk.verify(b"Hello!", signature))
+        # Without a salt, the salt is drawn from the seeded PRG
+        signature = self.sk.sign(b"Hello!", seed=shake("seed", 56))
+        self.assertEqual(signature[:20].hex(), "36075fbfc7a7d2b42cba832f2cac86896b365760")
+
+    def test_sign_many(self):
+        messages = [shake(f"m {i}", i) for i in range(100)]
+        signatures = self.sk.sign_many(messages, seed=shake("seed", 56))
+        self.assertEqual(hashlib.sha256(b"".join(signatures)).hexdigest(),
+                         "88f41c07c481fa04f6170bdff87c1aa19012da40a70a91767eb513cf08a84027")
+        valid, _ = self.pk.verify_many(messages, signatures)
+        self.assertTrue(valid.all())
+
+
+class TestLDLTree(unittest.TestCase):
+
+    # Values of the normalized tree of the original implementation, as nested lists, for
+    # the key of TestSeededSignature, at their place in the flat array: the sum of the
+    # moduli of each row, and the first and last column (the leftmost and rightmost nodes)
+    ROW_SUMS = [154.92673093053094, 21.27413366395622, 16.062483094939623, 6.387077962779456,
+                9.212124927844073, 3.4927633280438357, 91.12505787703478]
+    FIRST = [1.1353712205331172 - 1.145469564067564j, 0.11105878324851759 + 0.00545596816022992j,
+             0.13752289620877525 + 0.013544823041343693j, -0.021762891941679664 - 0.004328908357147506j,
+             0.06485724483147025 + 0.026864750427347445j, -0.03957606654145476 - 0.03957606654145472j,
+             1.2900259287968097]
+    LAST = [-0.997755064128248 + 4.04419811759541j, 0.09078178937866614 - 0.1514602652808129j,
+            -0.13206511176718624 - 0.24707644590465586j, -0.04046570993468493 + 0.06056121467860879j,
+            0.037781809484081615 + 0.09121335686746596j, 0.03957606654145356 - 0.03957606654145256j,
+            1.564952929164523]
+
+    def test_flat_tree(self):
+        T = SecretKey(64, TestSeededSignature.POLYS).T_fft
+        self.assertEqual(T.shape, (7, 64))
+        # The floating-point operations are done in another order: the values agree up to rounding
+        np.testing.assert_allclose(np.abs(T).sum(axis=1), self.ROW_SUMS, rtol=1e-12)
+        np.testing.assert_allclose(T[:, 0], self.FIRST, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(T[:, -1], self.LAST, rtol=1e-12, atol=1e-12)
+        # The leaves are real
+        self.assertFalse(T[-1].imag.any())
+
+
+class TestFFSampling(unittest.TestCase):
+
+    def sample_both(self, batch):
+        """Sample with ffsampling_fft and ffsampling_fft_inplace, from the same randomness."""
+        sk = SecretKey(64, TestSeededSignature.POLYS)
+        [[_, b], [_, d]] = sk.B0_fft
+        points = np.array([hash_to_point(shake(f"point {i}", 8), bytes(40), 64) for i in range(5)])
+        point_fft = fft(points[0] if batch == () else points)
+        t = [point_fft * d / q, -point_fft * b / q]
+        z = ffsampling_fft(t, sk.T_fft, sk.sigmin, RandomPool(ChaCha20(bytes(56)).randombytes))
+        z_inplace = ffsampling_fft_inplace(t, sk.T_fft, sk.sigmin, RandomPool(ChaCha20(bytes(56)).randombytes),
+                                           SamplingWorkspace(64, batch))
+        return z, z_inplace
+
+    def test_single(self):
+        # The scalar arithmetic at the bottom of the tree can differ from NumPy's in the
+        # last bit of the floats: the sampled integer vectors are the same
+        z, z_inplace = self.sample_both(())
+        for x, y in zip(z, z_inplace):
+            self.assertEqual(np.rint(ifft(x)).tolist(), np.rint(ifft(y)).tolist())
+
+    def test_batch(self):
+        z, z_inplace = self.sample_both((5,))
+        for x, y in zip(z, z_inplace):
+            self.assertEqual(x.tolist(), y.tolist())
+
+
+class TestSerialization(unittest.TestCase):
+
+    def setUp(self):
+        self.sk = SecretKey(64, TestSeededSignature.POLYS)
+        self.pk = PublicKey(self.sk)
+
+    def check_signs(self, sk):
+        """sk gives the recorded seeded signature."""
+        signature = sk.sign(b"Hello!", seed=shake("seed", 56), salt=shake("salt", 40))
+        self.assertEqual(signature.hex(), TestSeededSignature.SIGNATURE)
+
+    def test_public_key(self):
+        data = self.pk.to_bytes()
+        self.assertEqual(len(data), 1 + 64 * 14 // 8)
+        self.assertEqual(data[0], 0x06)
+        pk = PublicKey.from_bytes(data)
+        self.assertEqual(pk.h.tolist(), self.pk.h.tolist())
+        self.assertEqual(pk.to_bytes(), data)
+        signature = self.sk.sign(b"Hello!")
+        self.assertTrue(pk.verify(b"Hello!", signature))
+
+    def test_secret_key(self):
+        for precomputed in (False, True):
+            data = self.sk.to_bytes(precomputed=precomputed)
+            self.assertEqual(data[:2], bytes([0x56, 0x04 if precomputed else 0x00]))
+            sk = SecretKey.from_bytes(data)
+            for name in ("f", "g", "F", "G", "h"):
+                self.assertEqual(getattr(sk, name).tolist(), getattr(self.sk, name).tolist())
+            self.assertEqual(sk.to_bytes(precomputed=precomputed), data)
+            self.assertTrue((sk.T_fft == self.sk.T_fft).all())
+            self.check_signs(sk)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "key")
+            self.sk.save(path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.check_signs(SecretKey.load(path))
+            self.sk.save(path, precomputed=False)
+            self.check_signs(SecretKey.load(path))
+            with self.assertRaises(FileExistsError):
+                self.sk.save(path, exclusive=True)
+            # No temporary file is left behind
+            self.assertEqual(os.listdir(directory), ["key"])
+
+    def test_rejected_public_keys(self):
+        data = self.pk.to_bytes()
+        for invalid in [b"",
+                        # Bad headers: a secret key tag, and log2(n) = 11
+                        bytes([0x56]) + data[1:], bytes([0x0b]) + data[1:],
+                        # Wrong lengths
+                        data[:-1], data + b"\x00",
+                        # A coefficient of h which is not below q
+                        data[:1] + pack_bits([q] + self.pk.h.tolist()[1:], 14)]:
+            with self.assertRaises(ValueError):
+                PublicKey.from_bytes(invalid)
+
+    def test_rejected_secret_keys(self):
+        data = self.sk.to_bytes()
+        precomputed = self.sk.to_bytes(precomputed=True)
+        for invalid in [b"", data[:1],
+                        # Bad header
+                        bytes([0x06]) + data[1:],
+                        # Bad flags: unknown bit, and no integer size of 8 bytes
+                        data[:1] + bytes([0x08]) + data[2:], data[:1] + bytes([0x03]) + data[2:],
+                        # Wrong lengths, with and without the precomputed arrays
+                        data[:-1], data + b"\x00", precomputed[:-16], precomputed + bytes(16),
+                        # The precomputed arrays announced, but missing
+                        data[:1] + bytes([0x04]) + data[2:],
+                        # f, g, F, G which do not satisfy the NTRU equation
+                        data[:2] + bytes([data[2] ^ 1]) + data[3:]]:
+            with self.assertRaises(ValueError):
+                SecretKey.from_bytes(invalid)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests of the binary wire formats: frames and the minimal CBOR codec.
+
+Run with: python -m unittest test_wire
+"""
+import unittest
+from wire import (OCTET_STREAM, CBOR, CBOR_MAX_DEPTH, WireError, encode_frames, decode_frames,
+                  cbor_dumps, cbor_loads, decode_fields, encode_fields)
+
+
+class TestFrames(unittest.TestCase):
+
+    PAYLOADS = [b"", b"a", bytes(range(256)) * 3]
+
+    def test_round_trip(self):
+        data = encode_frames(self.PAYLOADS)
+        self.assertEqual(data[:9], bytes([0, 0, 0, 0, 0, 0, 0, 1]) + b"a")
+        payloads = decode_frames(data, len(self.PAYLOADS))
+        self.assertTrue(all(isinstance(payload, memoryview) for payload in payloads))
+        self.assertEqual([payload.tobytes() for payload in payloads], self.PAYLOADS)
+        self.assertEqual(decode_frames(b"", 0), [])
+
+    def test_truncated(self):
+        data = encode_frames(self.PAYLOADS)
+        for length in (len(data) - 1, 2, 6):
+            with self.assertRaises(WireError):
+                decode_frames(data[:length], len(self.PAYLOADS))
+        # Fewer frames than expected
+        with self.assertRaises(WireError):
+            decode_frames(data, len(self.PAYLOADS) + 1)
+
+    def test_trailing_data(self):
+        data = encode_frames(self.PAYLOADS)
+        with self.assertRaisesRegex(WireError, "Trailing"):
+            decode_frames(data + b"\x00", len(self.PAYLOADS))
+        with self.assertRaisesRegex(WireError, "Trailing"):
+            decode_frames(data, len(self.PAYLOADS) - 1)
+
+
+class TestCBOR(unittest.TestCase):
+
+    def test_encoding(self):
+        # Examples of RFC 8949, appendix A
+        for obj, encoding in [(0, "00"), (23, "17"), (24, "1818"), (1000, "1903e8"),
+                              (1000000, "1a000f4240"), (18446744073709551615, "1bffffffffffffffff"),
+                              (-1, "20"), (-1000, "3903e7"), (False, "f4"), (True, "f5"), (None, "f6"),
+                              (b"\x01\x02\x03\x04", "4401020304"), ("IETF", "6449455446"),
+                              ([1, [2, 3]], "8201820203"), ({"a": 1, "b": [2, 3]}, "a26161016162820203")]:
+            self.assertEqual(cbor_dumps(obj).hex(), encoding)
+        with self.assertRaises(WireError):
+            cbor_dumps(1 << 64)
+        with self.assertRaises(TypeError):
+            cbor_dumps(1.5)
+
+    def test_round_trip(self):
+        obj = {"message": b"Hello!", "n": 512, "offset": -7, "flags": [True, False, None],
+               "nested": {"signature": bytes(666)}}
+        decoded = cbor_loads(cbor_dumps(obj))
+        self.assertEqual(decoded[b"n"], 512)
+        self.assertEqual(decoded[b"offset"], -7)
+        self.assertEqual(decoded[b"flags"], [True, False, None])
+        # Strings are memoryviews of the encoding, and map keys are bytes
+        self.assertIsInstance(decoded[b"message"], memoryview)
+        self.assertEqual(decoded[b"message"].tobytes(), b"Hello!")
+        self.assertEqual(decoded[b"nested"][b"signature"].tobytes(), bytes(666))
+
+    def test_truncated(self):
+        data = cbor_dumps({"message": b"Hello!", "list": [1, 1000, 1000000]})
+        for length in range(len(data)):
+            with self.assertRaises(WireError):
+                cbor_loads(data[:length])
+
+    def test_trailing_data(self):
+        with self.assertRaisesRegex(WireError, "Trailing"):
+            cbor_loads(cbor_dumps([1, 2]) + b"\x00")
+
+    def test_nesting_limit(self):
+        nested = []
+        for _ in range(CBOR_MAX_DEPTH):
+            nested = [nested]
+        self.assertEqual(cbor_loads(cbor_dumps(nested)), nested)
+        with self.assertRaisesRegex(WireError, "nesting"):
+            cbor_loads(cbor_dumps([nested]))
+        # A long run of array heads fails early, without recursing through all of them
+        with self.assertRaisesRegex(WireError, "nesting"):
+            cbor_loads(b"\x81" * 100000)
+
+    def test_unsupported(self):
+        for data in [
+                # Indefinite-length byte string, array and map
+                b"\x5f\x41\x00\xff", b"\x9f\x01\xff", b"\xbf\x61\x61\x01\xff",
+                # Reserved additional information
+                b"\x1c",
+                # Tag, float and undefined
+                b"\xc0\x00", b"\xf9\x00\x00", b"\xf7",
+                # Array as a map key
+                b"\xa1\x80\x00"]:
+            with self.assertRaises(WireError):
+                cbor_loads(data)
+
+
+class TestFields(unittest.TestCase):
+
+    def test_round_trip(self):
+        for media_type in (OCTET_STREAM, CBOR):
+            data = encode_fields({"message": b"Hello!", "signature": bytes(40)}, media_type)
+            message, signature = decode_fields(data, media_type, ["message", "signature"])
+            self.assertEqual(message.tobytes(), b"Hello!")
+            self.assertEqual(signature.tobytes(), bytes(40))
+        self.assertEqual(encode_fields({"valid": True}, OCTET_STREAM), bytes([0, 0, 0, 1, 1]))
+        self.assertEqual(encode_fields({"valid": True}, CBOR), cbor_dumps({"valid": True}))
+
+    def test_invalid(self):
+        with self.assertRaisesRegex(WireError, "map"):
+            decode_fields(cbor_dumps([b"Hello!"]), CBOR, ["message"])
+        with self.assertRaisesRegex(WireError, "Missing"):
+            decode_fields(cbor_dumps({"message": 1}), CBOR, ["message"])
+        with self.assertRaisesRegex(WireError, "media type"):
+            decode_fields(b"", "application/json", ["message"])
+        with self.assertRaisesRegex(WireError, "media type"):
+            encode_fields({}, "application/json")
+
+
+if __name__ == "__main__":
+    unittest.main()
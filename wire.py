@@ -0,0 +1,191 @@
+"""
+Binary wire formats of the service, as alternatives to hex strings in JSON:
+- application/octet-stream: a sequence of frames, each a 4-byte big-endian
+  length followed by that many bytes
+- application/cbor: a CBOR map (RFC 8949), with the minimal codec below
+Decoding never copies the payloads: the byte strings are returned as memoryview
+slices of the received body, which the encoding and verification routines read directly.
+"""
+import struct
+
+OCTET_STREAM = "application/octet-stream"
+CBOR = "application/cbor"
+MEDIA_TYPES = (OCTET_STREAM, CBOR)
+
+# Length prefix of a frame
+FRAME_HEADER = struct.Struct(">I")
+
+# CBOR major types, and simple values
+CBOR_UINT, CBOR_NINT, CBOR_BYTES, CBOR_TEXT, CBOR_ARRAY, CBOR_MAP = range(6)
+CBOR_SIMPLE = 7
+CBOR_FALSE, CBOR_TRUE, CBOR_NULL = 20, 21, 22
+# Nesting depth of the decoded CBOR items
+CBOR_MAX_DEPTH = 16
+
+
+class WireError(ValueError):
+    """Raised when a body is not a valid encoding in the expected format."""
+
+
+def encode_frames(payloads):
+    """Encode a sequence of byte strings as length-prefixed frames."""
+    data = bytearray()
+    for payload in payloads:
+        data += FRAME_HEADER.pack(len(payload))
+        data += payload
+    return bytes(data)
+
+
+def decode_frames(data, count):
+    """
+    Decode exactly count length-prefixed frames from data,
+    and return their payloads as memoryviews of data.
+    """
+    view = memoryview(data)
+    payloads = []
+    offset = 0
+    for _ in range(count):
+        if len(view) - offset < FRAME_HEADER.size:
+            raise WireError("Truncated frame header")
+        length, = FRAME_HEADER.unpack_from(view, offset)
+        offset += FRAME_HEADER.size
+        if len(view) - offset < length:
+            raise WireError("Truncated frame")
+        payloads.append(view[offset:offset + length])
+        offset += length
+    if offset != len(view):
+        raise WireError("Trailing data after the last frame")
+    return payloads
+
+
+def cbor_head(major, argument):
+    """Encode the head of a CBOR item: the major type and its argument."""
+    if argument < 24:
+        return bytes([major << 5 | argument])
+    for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if argument < 1 << (8 * size):
+            return bytes([major << 5 | info]) + argument.to_bytes(size, "big")
+    raise WireError("Integer too large for CBOR")
+
+
+def cbor_dumps(obj):
+    """
+    Encode obj in CBOR. The supported types are None, bool, int, bytes-like
+    objects, str, and lists, tuples and dicts of those.
+    """
+    if obj is None:
+        return bytes([CBOR_SIMPLE << 5 | CBOR_NULL])
+    if obj is True or obj is False:
+        return bytes([CBOR_SIMPLE << 5 | (CBOR_TRUE if obj else CBOR_FALSE)])
+    if isinstance(obj, int):
+        return cbor_head(CBOR_UINT, obj) if obj >= 0 else cbor_head(CBOR_NINT, -1 - obj)
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return cbor_head(CBOR_BYTES, len(obj)) + bytes(obj)
+    if isinstance(obj, str):
+        text = obj.encode("utf-8")
+        return cbor_head(CBOR_TEXT, len(text)) + text
+    if isinstance(obj, (list, tuple)):
+        return cbor_head(CBOR_ARRAY, len(obj)) + b"".join(cbor_dumps(item) for item in obj)
+    if isinstance(obj, dict):
+        return cbor_head(CBOR_MAP, len(obj)) + b"".join(
+            cbor_dumps(key) + cbor_dumps(value) for key, value in obj.items())
+    raise TypeError(f"Cannot encode {type(obj).__name__} in CBOR")
+
+
+def cbor_decode_item(view, offset, depth):
+    """Decode the CBOR item of view starting at offset, and return it with the offset of the next one."""
+    if depth > CBOR_MAX_DEPTH:
+        raise WireError("CBOR nesting too deep")
+    if offset >= len(view):
+        raise WireError("Truncated CBOR item")
+    major, info = view[offset] >> 5, view[offset] & 0x1F
+    offset += 1
+    if major == CBOR_SIMPLE:
+        simple = {CBOR_FALSE: False, CBOR_TRUE: True, CBOR_NULL: None}
+        if info not in simple:
+            raise WireError("Unsupported CBOR simple value")
+        return simple[info], offset
+    if info < 24:
+        argument = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        if len(view) - offset < size:
+            raise WireError("Truncated CBOR item")
+        argument = int.from_bytes(view[offset:offset + size], "big")
+        offset += size
+    else:
+        # Indefinite lengths are not supported
+        raise WireError("Unsupported CBOR length")
+    if major == CBOR_UINT:
+        return argument, offset
+    if major == CBOR_NINT:
+        return -1 - argument, offset
+    if major in (CBOR_BYTES, CBOR_TEXT):
+        if len(view) - offset < argument:
+            raise WireError("Truncated CBOR string")
+        # Text strings are also returned as memoryviews (of their UTF-8 encoding)
+        return view[offset:offset + argument], offset + argument
+    if major == CBOR_ARRAY:
+        items = []
+        for _ in range(argument):
+            item, offset = cbor_decode_item(view, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    if major == CBOR_MAP:
+        items = {}
+        for _ in range(argument):
+            key, offset = cbor_decode_item(view, offset, depth + 1)
+            if isinstance(key, memoryview):
+                key = key.tobytes()
+            elif isinstance(key, list):
+                raise WireError("Unsupported CBOR map key")
+            items[key], offset = cbor_decode_item(view, offset, depth + 1)
+        return items, offset
+    raise WireError("Unsupported CBOR tag")
+
+
+def cbor_loads(data):
+    """
+    Decode a CBOR item from data. Byte and text strings are returned as memoryviews
+    of data (map keys as bytes), and only definite lengths are supported.
+    """
+    view = memoryview(data)
+    obj, offset = cbor_decode_item(view, 0, 0)
+    if offset != len(view):
+        raise WireError("Trailing data after the CBOR item")
+    return obj
+
+
+def decode_fields(data, media_type, fields):
+    """
+    Decode the byte strings named fields from a body in the given media type:
+    the frames in the order of fields, or the values of a CBOR map with these keys.
+    Return them as memoryviews of data.
+    """
+    if media_type == OCTET_STREAM:
+        return decode_frames(data, len(fields))
+    if media_type == CBOR:
+        obj = cbor_loads(data)
+        if not isinstance(obj, dict):
+            raise WireError("The CBOR body must be a map")
+        values = []
+        for field in fields:
+            value = obj.get(field.encode("utf-8"))
+            if not isinstance(value, memoryview):
+                raise WireError(f"Missing byte or text string {field!r}")
+            values.append(value)
+        return values
+    raise WireError(f"Unsupported media type {media_type!r}")
+
+
+def encode_fields(values, media_type):
+    """
+    Encode the dict values in the given media type: as frames in order (booleans
+    as a single byte), or as a CBOR map.
+    """
+    if media_type == OCTET_STREAM:
+        return encode_frames(bytes([value]) if isinstance(value, bool) else value
+                             for value in values.values())
+    if media_type == CBOR:
+        return cbor_dumps(values)
+    raise WireError(f"Unsupported media type {media_type!r}")